@@ -0,0 +1,176 @@
+""" Merging of queued output lines within the server's limits.
+"""
+
+from sendqueue import split_line
+
+# longest line without the \r\n
+MAX_LENGTH = 510
+
+class OutputBatcher:
+    """ Combines a line about to be sent with compatible queued lines:
+        - consecutive JOINs without keys are joined into one comma
+          separated JOIN
+        - consecutive MODE changes to one channel are merged, and split
+          so that a line has at most MODES changes with a parameter
+        - identical PRIVMSGs and NOTICEs at the head of several targets'
+          queues are sent once to all of them, up to TARGMAX targets,
+          unless they start a unit of several lines
+        The limits come from the ISupport given to the constructor.
+    """
+    def __init__(self, isupport):
+        self.isupport = isupport
+
+    def combine(self, line, queue):
+        """ Returns line combined with lines taken from queue.
+        """
+        command, target = split_line(line)
+        if command == 'JOIN':
+            return self.__join(line, queue)
+        if command == 'MODE' and target[:1] in self.isupport.chantypes():
+            return self.__mode(line, target, queue)
+        if command in ('PRIVMSG', 'NOTICE'):
+            return self.__message(line, command, queue)
+        return line
+
+    def __join(self, line, queue):
+        """ Combines JOIN lines which directly follow each other, so that
+            no JOIN is moved past a PART or QUIT.
+            For internal use.
+        """
+        parts = line.split()
+        if len(parts) != 2 or parts[1] == '0':
+            return line # JOIN with keys or a part from all channels
+        channels = parts[1].split(',')
+        limit = self.isupport.max_targets('JOIN')
+        state = {'length': len(line)}
+        def accept(other):
+            other = other.split()
+            if len(other) != 2 or other[0].upper() != 'JOIN' or \
+               other[1] == '0':
+                return False
+            more = other[1].split(',')
+            if limit and len(channels) + len(more) > limit:
+                return False
+            length = state['length'] + len(other[1]) + 1
+            if length > MAX_LENGTH:
+                return False
+            state['length'] = length
+            channels.extend(more)
+            return True
+        if not queue.take_priority(accept):
+            return line
+        return 'JOIN ' + ','.join(channels)
+
+    def __parse_modes(self, line):
+        """ Parses a channel MODE line into a list of
+            (sign, mode, parameter or None) tuples.
+            Returns None if the line can't be parsed.
+            For internal use.
+        """
+        parts = line.split()
+        if len(parts) < 3:
+            return None
+        lists, always, when_set, _ = self.isupport.chanmodes()
+        with_param = self.isupport.prefix()[0] + lists + always
+        params = iter(parts[3:])
+        changes = []
+        sign = '+'
+        for mode in parts[2]:
+            if mode in '+-':
+                sign = mode
+            elif mode in with_param or (sign == '+' and mode in when_set):
+                param = next(params, None)
+                if param is None:
+                    # a list query, e.g. MODE #channel b, or a bad line
+                    return None
+                changes.append((sign, mode, param))
+            else:
+                changes.append((sign, mode, None))
+        if next(params, None) is not None:
+            return None
+        return changes
+
+    def __build_modes(self, target, changes):
+        """ Builds a MODE line from changes.
+            For internal use.
+        """
+        modestring = ''
+        params = []
+        sign = None
+        for change_sign, mode, param in changes:
+            if change_sign != sign:
+                sign = change_sign
+                modestring += sign
+            modestring += mode
+            if param is not None:
+                params.append(param)
+        return ' '.join(['MODE', target, modestring] + params)
+
+    def __mode(self, line, target, queue):
+        """ Merges and splits MODE changes to target.
+            For internal use.
+        """
+        changes = self.__parse_modes(line)
+        if not changes:
+            return line
+        limit = self.isupport.modes()
+        def with_param(changes):
+            return sum(1 for change in changes if change[2] is not None)
+        # take following MODE lines to the same channel
+        while not limit or with_param(changes) < limit:
+            other = queue.peek_target(target)
+            if other is None or split_line(other)[0] != 'MODE':
+                break
+            more = self.__parse_modes(other)
+            if more is None:
+                break
+            queue.pop_target(target)
+            changes.extend(more)
+        # send as many changes as fit, put the rest back to the queue
+        count = 0
+        length = len('MODE %s +' % target)
+        for index, (sign, mode, param) in enumerate(changes):
+            if param is not None:
+                if limit and count == limit:
+                    break
+                count += 1
+                length += len(param) + 1
+            length += 2
+            if length > MAX_LENGTH:
+                break
+        else:
+            index = len(changes)
+        index = max(index, 1)
+        if index < len(changes):
+            queue.push_front(self.__build_modes(target, changes[index:]))
+        return self.__build_modes(target, changes[:index])
+
+    def __message(self, line, command, queue):
+        """ Sends an identical message to several targets at once.
+            For internal use.
+        """
+        limit = self.isupport.max_targets(command)
+        if limit == 1:
+            return line
+        head, separator, text = line.partition(' :')
+        parts = head.split()
+        if not separator or len(parts) != 2:
+            return line
+        targets = parts[1].split(',')
+        length = len(line)
+        for target in queue.waiting_targets():
+            if limit and len(targets) >= limit:
+                break
+            if target in targets or queue.starts_unit(target):
+                continue # the rest of a unit must follow its first line
+            if queue.peek_target(target) != '%s %s :%s' % (command, target,
+                                                            text):
+                continue
+            if length + len(target) + 1 > MAX_LENGTH:
+                break
+            queue.pop_target(target)
+            targets.append(target)
+            length += len(target) + 1
+        if len(targets) == 1:
+            return line
+        return '%s %s :%s' % (command, ','.join(targets), text)
@@ -0,0 +1,60 @@
+""" Benchmarks for mib.
+    Run from the top directory of mib:
+        python2 -m bench.micro     micro benchmarks of the hot paths
+        python2 -m bench.replay    end-to-end runs against a fake server
+        python2 -m bench.compare   comparison of two saved reports
+    Reports are JSON files tagged with the git commit they were made at,
+    so results from different commits can be compared.
+"""
+
+import json
+import platform
+import subprocess
+import time
+
+def commit():
+    """ Returns the current git commit, or '' outside a git checkout.
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short',
+                                        'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+def report(kind, results):
+    """ Returns a report dict of results.
+    """
+    return {'kind': kind,
+            'commit': commit(),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'results': results}
+
+def save(data, filename):
+    f = open(filename, 'w')
+    try:
+        json.dump(data, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
+
+def load(filename):
+    f = open(filename)
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def make_mib(**settings):
+    """ Creates a Mib with no plugins, overriding config with settings.
+        Must be called from the top directory of mib.
+    """
+    import config
+    config.LOAD_PLUGINS = []
+    config.CMD_PREFIXES = ['!']
+    config.METRICS_ADDRESS = None
+    config.RATE_LIMIT_USER = config.RATE_LIMIT_CHANNEL = None
+    config.RECONNECT_DELAY = config.LAG_CHECK_INTERVAL = None
+    for name, value in settings.iteritems():
+        setattr(config, name, value)
+    import mib
+    return mib.Mib()
@@ -0,0 +1,30 @@
+""" Compares two benchmark reports.
+    Usage: python2 -m bench.compare old.json new.json
+"""
+
+import sys
+
+import bench
+
+def main():
+    if len(sys.argv) != 3:
+        raise SystemExit(__doc__.strip())
+    old = bench.load(sys.argv[1])
+    new = bench.load(sys.argv[2])
+    print '%-32s %14s %14s %8s' % ('', old['commit'] or sys.argv[1],
+                                   new['commit'] or sys.argv[2], 'change')
+    for name in sorted(set(old['results']) | set(new['results'])):
+        before = old['results'].get(name)
+        after = new['results'].get(name)
+        if not isinstance(before, (int, float)) or \
+           not isinstance(after, (int, float)) or \
+           isinstance(before, bool):
+            print '%-32s %14s %14s' % (name, before, after)
+            continue
+        change = ''
+        if before:
+            change = '%+.1f%%' % ((after - before) * 100.0 / before)
+        print '%-32s %14.6g %14.6g %8s' % (name, before, after, change)
+
+if __name__ == '__main__':
+    main()
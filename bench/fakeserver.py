@@ -0,0 +1,85 @@
+""" A local stand-in for an IRC server.
+"""
+
+import socket
+import threading
+import time
+
+class FakeServer:
+    """ Accepts one client, sends it lines at a controlled rate and
+        records what it sends back.
+        Lines from the client containing "BENCH <token>" are replies
+        to probes; the time they arrived is kept in reply_times.
+    """
+    def __init__(self, host='127.0.0.1'):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+        self.conn = None
+        self.received = [] # (time, line)
+        self.reply_times = {} # probe token : time
+        self.replied = threading.Condition()
+
+    def accept(self, timeout=10):
+        """ Waits for the client to connect.
+        """
+        self.listener.settimeout(timeout)
+        self.conn, _ = self.listener.accept()
+        self.listener.close()
+        reader = threading.Thread(target=self.__read, name='fake server')
+        reader.daemon = True
+        reader.start()
+
+    def __read(self):
+        """ Reads and records lines from the client.
+            For internal use.
+        """
+        f = self.conn.makefile('r')
+        for line in f:
+            now = time.time()
+            line = line.rstrip('\r\n')
+            self.received.append((now, line))
+            if 'BENCH ' in line:
+                token = line.split('BENCH ', 1)[1].split()[0]
+                with self.replied:
+                    self.reply_times[token] = now
+                    self.replied.notify_all()
+
+    def wait_reply(self, token, timeout=60):
+        """ Waits until the reply to probe token has arrived.
+            Returns False on timeout.
+        """
+        deadline = time.time() + timeout
+        with self.replied:
+            while token not in self.reply_times:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.replied.wait(remaining)
+        return True
+
+    def send(self, lines, rate=0, on_send=None):
+        """ Sends lines to the client, rate lines per second,
+            or as fast as possible if rate is 0.
+            on_send is called with the index and send time of each line.
+        """
+        chunk = max(1, int(rate / 100)) if rate else 500
+        start = time.time()
+        for index in range(0, len(lines), chunk):
+            if rate:
+                delay = start + index / float(rate) - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            batch = lines[index:index + chunk]
+            now = time.time()
+            if on_send:
+                for offset in range(len(batch)):
+                    on_send(index + offset, now)
+            self.conn.sendall(''.join(line + '\r\n' for line in batch))
+
+    def close(self):
+        if self.conn:
+            self.conn.shutdown(socket.SHUT_RDWR)
+            self.conn.close()
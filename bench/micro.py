@@ -0,0 +1,101 @@
+""" Micro benchmarks of parsing, dispatch and permission matching.
+    Usage: python2 -m bench.micro [--output report.json] [--number N]
+"""
+
+import logging
+import optparse
+import timeit
+
+import bench
+from masks import PermissionTable
+from ircutils import regexpify
+import parser
+from patterns import PatternMatcher
+
+LINES = {
+    'privmsg': ':nick!user@host.example.com PRIVMSG #channel :hello there',
+    'command': ':nick!user@host.example.com PRIVMSG #channel :! topic x y',
+    'tagged': '@time=2013-01-16T12:00:00.000Z;account=nick '
+              ':nick!user@host.example.com PRIVMSG #channel :hello there',
+    'numeric': ':irc.example.com 353 mib = #channel :' +
+               ' '.join('@nick%d' % i for i in range(50)),
+    'ping': 'PING :irc.example.com',
+}
+
+def run(name, function, number, scale=1):
+    """ Returns the number of calls of function per second,
+        multiplied by scale for functions which do scale operations.
+    """
+    best = min(timeit.repeat(function, number=number, repeat=3))
+    rate = number * scale / best
+    print '%-32s %12.0f ops/s' % (name, rate)
+    return rate
+
+def benchmarks(number):
+    results = {}
+    for name, line in sorted(LINES.items()):
+        results['parse.' + name] = run('parse.' + name,
+                                       lambda line=line: parser.parse(line),
+                                       number)
+    many = LINES.values() * 20
+    results['parse_many'] = run('parse_many',
+                                lambda: parser.parse_many(many),
+                                number / len(many), len(many))
+    prefix = 'nick!user@host.example.com'
+    results['parse_prefix'] = run('parse_prefix',
+                                  lambda: parser.parse_prefix(prefix), number)
+    results['msg.split_command'] = run(
+        'msg.split_command',
+        lambda: parser.parse(LINES['command']).split_command(set(['!'])),
+        number)
+
+    table = PermissionTable()
+    for i in range(100):
+        table.add('topic', regexpify('*!*@host%d.example.com' % i))
+    results['permission.cached'] = run(
+        'permission.cached', lambda: table.allowed('topic', prefix), number)
+    prefixes = ['nick%d!user@host.example.com' % i for i in range(5000)]
+    iterator = iter(prefixes * (number * 3 / len(prefixes) + 1))
+    uncached = PermissionTable(cache_size=1)
+    for pattern in table['topic']:
+        uncached.add('topic', pattern)
+    results['permission.uncached'] = run(
+        'permission.uncached', lambda: uncached.allowed('topic',
+                                                        next(iterator)),
+        number)
+
+    patterns = PatternMatcher()
+    def found(msg, match):
+        pass
+    for i in range(200):
+        patterns.add_keyword('keyword%d' % i, found)
+    for i in range(20):
+        patterns.add_regexp(r'\bpattern%d\s+(\w+)' % i, found)
+    text = parser.parse(LINES['privmsg']).postfix * 5
+    results['patterns.miss'] = run('patterns.miss',
+                                   lambda: patterns.match(text), number)
+
+    mib = bench.make_mib(EXECUTOR_THREADS=0)
+    def callback(msg):
+        pass
+    mib.register_cmd('PRIVMSG', callback)
+    mib.register_privmsg_cmd('topic', callback)
+    results['dispatch.privmsg'] = run(
+        'dispatch.privmsg', lambda: mib.parse_line(LINES['privmsg']), number)
+    results['dispatch.command'] = run(
+        'dispatch.command', lambda: mib.parse_line(LINES['command']), number)
+    return results
+
+def main():
+    option_parser = optparse.OptionParser(usage='%prog [options]')
+    option_parser.add_option('-o', '--output', help='save report to file')
+    option_parser.add_option('-n', '--number', type='int', default=20000,
+                             help='calls per measurement [%default]')
+    options, args = option_parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    data = bench.report('micro', benchmarks(options.number))
+    if options.output:
+        bench.save(data, options.output)
+
+if __name__ == '__main__':
+    main()
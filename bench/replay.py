@@ -0,0 +1,146 @@
+""" End-to-end benchmark: runs mib against a local fake server.
+    Usage: python2 -m bench.replay [options]
+    Scenarios: ping, chatter, storm, names, netsplit, mixed, file
+"""
+
+import logging
+import optparse
+import os
+import resource
+import sys
+import threading
+import time
+
+import bench
+from bench import traffic
+from bench.fakeserver import FakeServer
+
+CHANNEL = '#bench'
+NICK = 'mib'
+
+def scenario_lines(options):
+    count = options.lines
+    if options.scenario == 'ping':
+        return traffic.pings(count)
+    if options.scenario == 'chatter':
+        return traffic.chatter(CHANNEL, count)
+    if options.scenario == 'storm':
+        return traffic.command_storm(CHANNEL, count)
+    if options.scenario == 'names':
+        return traffic.names_flood(CHANNEL, NICK, count * 50)
+    if options.scenario == 'netsplit':
+        return traffic.netsplit(CHANNEL, count / 2)
+    if options.scenario == 'mixed':
+        return traffic.mixed(CHANNEL, NICK, count)
+    if options.scenario == 'file':
+        return traffic.from_file(options.file)
+    raise SystemExit('Unknown scenario %s' % options.scenario)
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def replay(options):
+    """ Runs one scenario and returns the results as a dict.
+    """
+    server = FakeServer()
+    settings = {'SERVER': ('127.0.0.1', server.port),
+                'NICK': NICK,
+                'CHANNELS': [CHANNEL],
+                'EXECUTOR_THREADS': options.threads}
+    if not options.flood_control:
+        settings['SEND_RATE'] = settings['SEND_BURST'] = 10 ** 9
+    mib = bench.make_mib(**settings)
+
+    def probe(msg):
+        mib.socket.send('PRIVMSG %s :BENCH %s' % (CHANNEL, msg.postfix))
+    def storm(msg):
+        mib.socket.send('PRIVMSG %s :storm %s' % (CHANNEL, msg.postfix))
+    mib.register_privmsg_cmd('probe', probe)
+    mib.register_privmsg_cmd('storm', storm)
+
+    sys.stdin = open(os.devnull)
+    runner = threading.Thread(target=mib.run, name='mib')
+    runner.start()
+    server.accept()
+    server.send(traffic.registration(NICK) +
+                [':%s!%s@bench JOIN %s' % (NICK, NICK, CHANNEL)])
+
+    lines = scenario_lines(options)
+    probes = {} # line index : token
+    if options.probe_every:
+        for index in range(options.probe_every, len(lines),
+                           options.probe_every + 1):
+            token = str(index)
+            lines.insert(index, ':prober!p@bench PRIVMSG %s :! probe %s'
+                         % (CHANNEL, token))
+            probes[index] = token
+    lines.append(':prober!p@bench PRIVMSG %s :! probe done' % CHANNEL)
+    sent_times = {}
+    def on_send(index, now):
+        if index in probes:
+            sent_times[probes[index]] = now
+
+    start = time.time()
+    server.send(lines, options.rate, on_send)
+    finished = server.wait_reply('done', options.timeout)
+    elapsed = time.time() - start
+    if finished:
+        elapsed = server.reply_times['done'] - start
+    server.close()
+    runner.join(10)
+    mib.clean()
+
+    latencies = [server.reply_times[token] - sent
+                 for token, sent in sent_times.items()
+                 if token in server.reply_times]
+    return {'scenario': options.scenario,
+            'lines': len(lines),
+            'rate': options.rate,
+            'completed': finished,
+            'seconds': elapsed,
+            'lines_per_second': len(lines) / elapsed if elapsed else 0,
+            'probes': len(sent_times),
+            'probe_replies': len(latencies),
+            'latency_p50': percentile(latencies, 0.5),
+            'latency_p90': percentile(latencies, 0.9),
+            'latency_p99': percentile(latencies, 0.99),
+            'latency_max': max(latencies) if latencies else 0.0,
+            # kilobytes on Linux; includes the fake server
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+def main():
+    option_parser = optparse.OptionParser(usage='%prog [options]')
+    option_parser.add_option('-s', '--scenario', default='mixed',
+                             help='ping, chatter, storm, names, netsplit, '
+                                  'mixed or file [%default]')
+    option_parser.add_option('-f', '--file',
+                             help='recorded traffic for the file scenario')
+    option_parser.add_option('-l', '--lines', type='int', default=20000,
+                             help='lines of traffic [%default]')
+    option_parser.add_option('-r', '--rate', type='float', default=0,
+                             help='lines per second, 0 for as fast as '
+                                  'possible [%default]')
+    option_parser.add_option('-p', '--probe-every', type='int', default=100,
+                             help='send a latency probe every N lines '
+                                  '[%default]')
+    option_parser.add_option('-t', '--threads', type='int', default=4,
+                             help='plugin worker threads [%default]')
+    option_parser.add_option('--flood-control', action='store_true',
+                             help='keep the configured flood control')
+    option_parser.add_option('--timeout', type='float', default=120,
+                             help='seconds to wait for the bot [%default]')
+    option_parser.add_option('-o', '--output', help='save report to file')
+    options, args = option_parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    results = replay(options)
+    for name, value in sorted(results.items()):
+        print '%-20s %s' % (name, value)
+    if options.output:
+        bench.save(bench.report('replay', results), options.output)
+
+if __name__ == '__main__':
+    main()
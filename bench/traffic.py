@@ -0,0 +1,61 @@
+""" Synthetic and recorded IRC traffic.
+    Every function returns a list of lines as a server would send them.
+"""
+
+SERVER = 'irc.example.com'
+
+def user(i):
+    return 'user%d!ident%d@host%d.example.com' % (i, i, i % 1000)
+
+def registration(nick):
+    return [':%s 001 %s :Welcome' % (SERVER, nick),
+            ':%s 005 %s CHANTYPES=# PREFIX=(ov)@+ MODES=4 '
+            'CHANMODES=beI,k,l,imnpst :are supported' % (SERVER, nick),
+            ':%s 251 %s :There are 1 users' % (SERVER, nick),
+            ':%s 376 %s :End of MOTD' % (SERVER, nick)]
+
+def pings(count):
+    return ['PING :%s%d' % (SERVER, i) for i in range(count)]
+
+def chatter(channel, count):
+    return [':%s PRIVMSG %s :message number %d with some words in it'
+            % (user(i), channel, i) for i in range(count)]
+
+def command_storm(channel, count, command='storm'):
+    return [':%s PRIVMSG %s :! %s %d' % (user(i), channel, command, i)
+            for i in range(count)]
+
+def names_flood(channel, nick, count):
+    lines = []
+    for start in range(0, count, 50):
+        names = ' '.join('%snick%d' % ('@' if i % 10 == 0 else '', i)
+                         for i in range(start, min(count, start + 50)))
+        lines.append(':%s 353 %s = %s :%s' % (SERVER, nick, channel, names))
+    lines.append(':%s 366 %s %s :End of /NAMES list.' % (SERVER, nick,
+                                                         channel))
+    return lines
+
+def netsplit(channel, count):
+    """ count users join channel and then leave in a netsplit.
+    """
+    return ([':%s JOIN %s' % (user(i), channel) for i in range(count)] +
+            [':%s QUIT :*.example.com *.split' % user(i)
+             for i in range(count)])
+
+def mixed(channel, nick, count):
+    """ A mix of all of the above, count lines in total.
+    """
+    part = max(1, count / 5)
+    lines = (names_flood(channel, nick, part * 50)[:part] +
+             chatter(channel, part) + netsplit(channel, part / 2) +
+             pings(part) + command_storm(channel, part))
+    return lines[:count]
+
+def from_file(filename):
+    """ Reads recorded traffic, one raw line per line.
+    """
+    f = open(filename)
+    try:
+        return [line.rstrip('\r\n') for line in f if line.strip()]
+    finally:
+        f.close()
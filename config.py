@@ -3,6 +3,67 @@ NICK = 'mib'
 USERNAME = 'mib'
 REALNAME = 'Modular IRC Bot'
 CHANNELS = []
+# IRCv3 capabilities to use if the server has them
+CAPABILITIES = ['multi-prefix']
 CMD_PREFIXES = []
 LOAD_PLUGINS = []
+# networks to connect to, name : dict of settings, e.g.
+# {'efnet': {'SERVER': ('irc.efnet.org', 6667), 'CHANNELS': ['#mib']}}
+# SERVER, NICK, USERNAME, REALNAME, CHANNELS and CAPABILITIES not given
+# for a network are taken from above; None connects only to SERVER
+NETWORKS = None
 
+# seconds to wait before connecting again, doubled after every failure
+# up to RECONNECT_MAX_DELAY; None to quit when the connection is lost
+RECONNECT_DELAY = 5
+RECONNECT_MAX_DELAY = 300
+LAG_CHECK_INTERVAL = 60 # seconds between lag check PINGs, None to disable
+LAG_TIMEOUT = 240 # reconnect if nothing is read in this many seconds
+
+SENDQ_SIZE = 1000
+SEND_RATE = 1.0
+SEND_BURST = 5
+
+LOG_LEVEL = 'INFO'
+LOG_LEVELS = {} # logger name : level, e.g. {'mib.socket': 'DEBUG'}
+LOG_FILE = None # log to stdout
+LOG_MAX_BYTES = 1048576
+LOG_BACKUPS = 5
+
+# processes running the plugins, sharded by channel;
+# 0 runs them in the process with the connection
+WORKER_PROCESSES = 0
+EXECUTOR_THREADS = 4 # 0 runs plugin callbacks in the event loop
+CALLBACK_TIMEOUT = 30 # seconds
+SLOW_CALLBACK = 1.0 # log callbacks slower than this many seconds, or None
+# plugin : dict of options for Executor.configure,
+# e.g. {'topic': {'max_concurrency': 1, 'ordered': True}}
+PLUGIN_EXECUTOR = {}
+
+# plugin key-value storage
+STORAGE_FILE = 'mib.db'
+STORAGE_CACHE_SIZE = 4096 # keys kept in memory
+STORAGE_FLUSH_INTERVAL = 1.0 # seconds between writes to the database
+
+# channel log with a full-text index, used by the seen plugin;
+# None to not keep one
+LOGSTORE_FILE = None
+LOGSTORE_SEGMENT_LINES = 1000 # lines compressed together
+LOGSTORE_FLUSH_INTERVAL = 1.0 # seconds between writes to the database
+
+# where the profiles made with the profile plugin are saved
+PROFILE_DIRECTORY = '.'
+PROFILE_SAMPLE_INTERVAL = 0.005 # seconds between samples
+
+# where to serve metrics in the Prometheus text format:
+# None, ('127.0.0.1', port) for HTTP or a path for a Unix socket
+METRICS_ADDRESS = None
+
+# privmsg command rate limits as (commands per second, burst), or None
+RATE_LIMIT_USER = (0.5, 5)
+RATE_LIMIT_CHANNEL = (2, 10)
+RATE_LIMIT_BUCKETS = 10000 # users and channels remembered at most
+COMMAND_COSTS = {} # command : tokens, default 1
+
+# replies of commands registered with a cache_ttl kept at most
+RESPONSE_CACHE_SIZE = 1024
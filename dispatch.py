@@ -0,0 +1,116 @@
+""" Dispatching of messages to registered handlers.
+"""
+
+import threading
+
+# handlers registered for every command
+WILDCARD = '*'
+
+class Dispatcher:
+    """ Handlers by command, and middleware that every message passes
+        before the handlers are called.
+        Handlers with a smaller priority are called first, handlers with
+        equal priorities in registration order. Handlers registered for
+        WILDCARD get every command. The ordered handler tuple of each
+        command is kept until the registrations change. Commands without
+        handlers of their own share the tuple of WILDCARD, so unknown
+        commands don't grow the table.
+        Middleware functions are called with (command, msg) in the order
+        they were added, only when the command has handlers. If one
+        returns False, the message is dropped and the rest are not called.
+        Handlers are called with call(function, msg).
+        The dispatcher can be changed from several threads.
+    """
+    def __init__(self, call):
+        self.call = call
+        self.handlers = {} # command : list((priority, serial, function))
+        self.serial = 0
+        self.middleware = ()
+        self.table = {} # command : tuple(function)
+        self.lock = threading.Lock()
+
+    def __contains__(self, cmd):
+        return cmd in self.handlers
+
+    def __iter__(self):
+        return iter(self.handlers.keys())
+
+    def __getitem__(self, cmd):
+        """ Returns the functions registered for cmd itself, in order.
+        """
+        return [entry[2] for entry in sorted(self.handlers[cmd])]
+
+    def register(self, cmd, function, priority=0):
+        """ Registers function to be called for cmd.
+            A function is registered only once for a command.
+        """
+        with self.lock:
+            entries = self.handlers.setdefault(cmd, [])
+            if any(entry[2] == function for entry in entries):
+                return
+            self.serial += 1
+            entries.append((priority, self.serial, function))
+            self.table.clear()
+
+    def unregister(self, cmd, function):
+        """ Removes function from cmd's handlers.
+        """
+        with self.lock:
+            entries = self.handlers.get(cmd, [])
+            entries[:] = [entry for entry in entries if entry[2] != function]
+            if not entries:
+                self.handlers.pop(cmd, None)
+            self.table.clear()
+
+    def remove_module(self, module):
+        """ Removes every handler and middleware defined in module.
+        """
+        with self.lock:
+            for cmd, entries in self.handlers.items():
+                entries[:] = [entry for entry in entries
+                              if entry[2].__module__ != module]
+                if not entries:
+                    del self.handlers[cmd]
+            self.middleware = tuple(function for function in self.middleware
+                                    if function.__module__ != module)
+            self.table.clear()
+
+    def add_middleware(self, function):
+        with self.lock:
+            self.middleware += (function,)
+
+    def remove_middleware(self, function):
+        with self.lock:
+            self.middleware = tuple(other for other in self.middleware
+                                    if other != function)
+
+    def handlers_for(self, cmd):
+        """ Returns the ordered tuple of functions to call for cmd.
+        """
+        if cmd not in self.handlers:
+            cmd = WILDCARD # shares the entry of the wildcard handlers
+        functions = self.table.get(cmd)
+        if functions is None:
+            with self.lock:
+                entries = self.handlers.get(WILDCARD, [])
+                if cmd != WILDCARD:
+                    entries = self.handlers.get(cmd, []) + entries
+                functions = tuple(entry[2] for entry in sorted(entries))
+                self.table[cmd] = functions
+        return functions
+
+    def dispatch(self, cmd, msg):
+        """ Passes msg through the middleware and calls cmd's handlers.
+            Returns False if there were no handlers or
+            the middleware dropped the message.
+        """
+        functions = self.handlers_for(cmd)
+        if not functions:
+            return False
+        for middleware in self.middleware:
+            if not middleware(cmd, msg):
+                return False
+        call = self.call
+        for function in functions:
+            call(function, msg)
+        return True
@@ -0,0 +1,176 @@
+""" Readiness driven event loop.
+"""
+
+from collections import deque
+import errno
+import heapq
+import os
+import select
+import thread
+import time
+
+class Timer:
+    """ Handle for a function scheduled with EventLoop.call_later
+        or EventLoop.call_every.
+    """
+    def __init__(self, when, function, args, interval=None):
+        self.when = when
+        self.function = function
+        self.args = args
+        self.interval = interval # seconds between calls, None for once
+        self.cancelled = False
+
+    def cancel(self):
+        """ Prevents the function from being called.
+        """
+        self.cancelled = True
+
+class EventLoop:
+    """ Calls registered functions when a file becomes readable or
+        writable, or when a timer is due.
+        The loop sleeps in select() until the next I/O event or the
+        next timer deadline, so an idle loop uses no CPU.
+    """
+    def __init__(self):
+        self.readers = {} # file : function
+        self.writers = {} # file : function
+        self.timers = [] # heap of (when, sequence, Timer)
+        self.sequence = 0
+        self.running = False
+        self.thread = None # id of the thread running the loop
+        self.pending = deque() # (function, args) from other threads
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        self.add_reader(self.wakeup_r, self.__run_pending)
+
+    def add_reader(self, f, function):
+        """ Calls function without parameters whenever f is readable.
+            f is anything select() accepts.
+        """
+        self.readers[f] = function
+
+    def remove_reader(self, f):
+        self.readers.pop(f, None)
+
+    def add_writer(self, f, function):
+        """ Calls function without parameters whenever f is writable.
+        """
+        self.writers[f] = function
+
+    def remove_writer(self, f):
+        self.writers.pop(f, None)
+
+    def call_later(self, delay, function, *args):
+        """ Calls function(*args) after delay seconds.
+            Returns a Timer that can be used to cancel the call.
+            Can be called from any thread.
+        """
+        timer = Timer(time.time() + delay, function, args)
+        self.__schedule(timer)
+        return timer
+
+    def call_every(self, interval, function, *args):
+        """ Calls function(*args) every interval seconds, starting
+            after the first interval, until the returned Timer is
+            cancelled. Calls that would have been missed because the loop
+            was busy are skipped. Can be called from any thread.
+        """
+        timer = Timer(time.time() + interval, function, args, interval)
+        self.__schedule(timer)
+        return timer
+
+    def __schedule(self, timer):
+        """ Adds timer to the heap in the loop's thread.
+            For internal use.
+        """
+        if not self.in_loop_thread():
+            self.call_soon_threadsafe(self.__schedule, timer)
+            return
+        self.sequence += 1
+        heapq.heappush(self.timers, (timer.when, self.sequence, timer))
+
+    def call_soon(self, function, *args):
+        """ Calls function(*args) on the next iteration of the loop.
+        """
+        return self.call_later(0, function, *args)
+
+    def call_soon_threadsafe(self, function, *args):
+        """ Calls function(*args) in the loop's thread.
+            Can be called from any thread.
+        """
+        self.pending.append((function, args))
+        os.write(self.wakeup_w, '\0')
+
+    def in_loop_thread(self):
+        """ Returns True if called from the thread running the loop,
+            or if the loop isn't running.
+        """
+        return self.thread is None or self.thread == thread.get_ident()
+
+    def __run_pending(self):
+        """ Calls the functions passed to call_soon_threadsafe.
+            For internal use.
+        """
+        os.read(self.wakeup_r, 4096)
+        while self.pending:
+            function, args = self.pending.popleft()
+            function(*args)
+
+    def stop(self):
+        """ Makes run() return after the current iteration.
+        """
+        self.running = False
+
+    def __run_timers(self):
+        """ Calls every timer that is due and returns the number of
+            seconds until the next one, or None if there are no timers.
+            For internal use.
+        """
+        while self.timers:
+            when, _, timer = self.timers[0]
+            if timer.cancelled:
+                heapq.heappop(self.timers)
+                continue
+            now = time.time()
+            if when > now:
+                return when - now
+            heapq.heappop(self.timers)
+            if timer.interval is not None:
+                timer.when = max(when + timer.interval, now)
+                self.__schedule(timer)
+            timer.function(*timer.args)
+        return None
+
+    def run(self):
+        """ The main loop. Runs until stop() is called.
+        """
+        self.running = True
+        self.thread = thread.get_ident()
+        try:
+            self.__run()
+        finally:
+            self.thread = None
+
+    def __run(self):
+        """ The body of run().
+            For internal use.
+        """
+        while self.running:
+            timeout = self.__run_timers()
+            if not self.running:
+                break
+            try:
+                readable, writable, _ = select.select(self.readers.keys(),
+                                                      self.writers.keys(),
+                                                      [], timeout)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for f in readable:
+                function = self.readers.get(f)
+                if function:
+                    function()
+            for f in writable:
+                function = self.writers.get(f)
+                if function:
+                    function()
@@ -0,0 +1,273 @@
+""" Running plugin callbacks outside the event loop.
+"""
+
+from collections import deque
+import logging
+import Queue
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger('mib.executor')
+
+CALLBACK_DURATION = metrics.histogram('mib_callback_duration_seconds',
+                                      'Time spent in plugin callbacks',
+                                      ('plugin', 'function'))
+CALLBACK_ERRORS = metrics.counter('mib_callback_errors_total',
+                                  'Exceptions raised by plugin callbacks',
+                                  ('plugin', 'function'))
+SLOW_CALLBACKS = metrics.counter('mib_slow_callbacks_total',
+                                 'Plugin callbacks slower than the threshold',
+                                 ('plugin', 'function'))
+CALLBACK_TIMEOUTS = metrics.counter('mib_callback_timeouts_total',
+                                    'Plugin callbacks that timed out',
+                                    ('plugin',))
+QUEUE_DEPTH = metrics.gauge('mib_plugin_queue_depth',
+                            'Running and waiting calls of a plugin',
+                            ('plugin',))
+
+class Task:
+    """ A single call of a plugin callback.
+    """
+    def __init__(self, plugin, function, args, key, context=None):
+        self.plugin = plugin
+        self.function = function
+        self.args = args
+        self.key = key
+        self.context = context
+        self.cancelled = False
+        self.finished = False
+        self.timed_out = False
+        self.started = None # time the call started
+        self.reported = False # logged as slow while running
+
+    def cancel(self):
+        """ Prevents the call if it hasn't started yet.
+        """
+        self.cancelled = True
+
+class Executor:
+    """ Runs plugin callbacks on a pool of worker threads.
+        Each plugin can be configured with
+        - max_concurrency: how many of its calls may run at the same time
+        - timeout: seconds after which a call is given up on; the call's
+          slot is freed so the plugin's other calls can continue, and a
+          new worker thread takes the place of the one left running it
+        - ordered: calls with the same key (channel) run one at a time
+          in the order they were submitted
+        - inline: calls are run directly in the event loop's thread
+        With no threads every call is run inline.
+        If set_context is given, it is called with the context of a call
+        in the thread that makes the call, just before it, and with None
+        after it.
+        Calls running longer than slow_threshold seconds are logged with
+        their plugin and arguments while they still run, or when they
+        return if they ran in the event loop's thread.
+        The running calls are checked for timeouts and slowness by one
+        timer of the loop, every half of the smaller of slow_threshold
+        and timeout, instead of by timers of each call.
+    """
+    def __init__(self, loop, threads=4, timeout=None, max_concurrency=None,
+                 set_context=None, slow_threshold=None):
+        self.loop = loop
+        self.set_context = set_context
+        self.slow_threshold = slow_threshold
+        self.defaults = {'max_concurrency': max_concurrency,
+                         'timeout': timeout,
+                         'ordered': False,
+                         'inline': threads == 0}
+        self.options = {} # plugin : dict(option : value)
+        self.running = {} # plugin : number of running calls
+        self.waiting = {} # plugin : deque(Task) waiting for a free slot
+        self.serial = {} # (plugin, key) : deque(Task) of an ordered plugin
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.workers = []
+        self.started = 0 # worker threads started, for their names
+        self.active = set() # Tasks running in the worker threads
+        for _ in range(threads):
+            self.__start_worker()
+        if threads:
+            limits = [limit for limit in (slow_threshold, timeout) if limit]
+            self.loop.call_every(min(limits or [1.0]) / 2.0, self.__watch)
+
+    def __start_worker(self):
+        """ Starts a worker thread.
+            For internal use.
+        """
+        worker = threading.Thread(target=self.__work,
+                                  name='plugin worker %d' % self.started)
+        self.started += 1
+        worker.daemon = True
+        worker.start()
+        self.workers.append(worker)
+
+    def configure(self, plugin, **options):
+        """ Sets the options listed in the class documentation for plugin.
+        """
+        self.options.setdefault(plugin, {}).update(options)
+
+    def option(self, plugin, name):
+        """ Returns the value of option name for plugin.
+        """
+        return self.options.get(plugin, {}).get(name, self.defaults[name])
+
+    def submit(self, plugin, function, arg, key=None, context=None):
+        """ Calls function(arg) according to plugin's options.
+            Returns the Task, which can be used to cancel the call.
+        """
+        return self.call(plugin, function, (arg,), key, context)
+
+    def call(self, plugin, function, args, key=None, context=None):
+        """ Like submit, but calls function(*args).
+        """
+        task = Task(plugin, function, args, key, context)
+        if plugin not in self.running:
+            self.running[plugin] = 0
+            QUEUE_DEPTH.set_function(lambda: self.depth(plugin), (plugin,))
+        if self.option(plugin, 'inline'):
+            self.__call(task)
+            return task
+        with self.lock:
+            if self.option(plugin, 'ordered'):
+                serial = self.serial.get((plugin, key))
+                if serial is not None:
+                    serial.append(task)
+                    return task
+                self.serial[(plugin, key)] = deque()
+            self.__schedule(task)
+        return task
+
+    def depth(self, plugin):
+        """ Returns the number of running and waiting calls of plugin.
+        """
+        with self.lock:
+            depth = self.running.get(plugin, 0)
+            depth += len(self.waiting.get(plugin, ()))
+            for (name, key), serial in self.serial.items():
+                if name == plugin:
+                    depth += len(serial)
+            return depth
+
+    def __schedule(self, task):
+        """ Queues task for a worker if the plugin has a free slot.
+            Must be called with the lock held.
+            For internal use.
+        """
+        limit = self.option(task.plugin, 'max_concurrency')
+        running = self.running.get(task.plugin, 0)
+        if limit and running >= limit:
+            self.waiting.setdefault(task.plugin, deque()).append(task)
+            return
+        self.running[task.plugin] = running + 1
+        self.queue.put(task)
+
+    def __finish(self, task):
+        """ Frees task's slot and schedules the tasks waiting for it.
+            For internal use.
+        """
+        with self.lock:
+            if task.finished:
+                return
+            task.finished = True
+            self.running[task.plugin] -= 1
+            if self.option(task.plugin, 'ordered'):
+                serial = self.serial.get((task.plugin, task.key))
+                if serial:
+                    self.__schedule(serial.popleft())
+                elif serial is not None:
+                    del self.serial[(task.plugin, task.key)]
+            waiting = self.waiting.get(task.plugin)
+            if waiting:
+                limit = self.option(task.plugin, 'max_concurrency')
+                if not limit or self.running[task.plugin] < limit:
+                    self.__schedule(waiting.popleft())
+
+    def __call(self, task):
+        """ Calls the task's function and logs the errors.
+            For internal use.
+        """
+        labels = (task.plugin, getattr(task.function, '__name__', '?'))
+        if self.set_context is not None:
+            self.set_context(task.context)
+        task.started = time.time()
+        try:
+            task.function(*task.args)
+        except Exception:
+            CALLBACK_ERRORS.inc(labels)
+            logger.exception('Error from function %r', task.function)
+        finally:
+            if self.set_context is not None:
+                self.set_context(None)
+        duration = time.time() - task.started
+        CALLBACK_DURATION.observe(duration, labels)
+        if self.slow_threshold and duration > self.slow_threshold:
+            if task.reported:
+                logger.info('Function %s of plugin %s took %.3f s',
+                            labels[1], task.plugin, duration)
+            else:
+                self.__report_slow(task, 'took')
+
+    def __report_slow(self, task, verb):
+        """ Logs a slow task with its arguments.
+            For internal use.
+        """
+        task.reported = True
+        name = getattr(task.function, '__name__', '?')
+        SLOW_CALLBACKS.inc((task.plugin, name))
+        logger.warning('Function %s of plugin %s %s %.3f s with %s',
+                       name, task.plugin, verb, time.time() - task.started,
+                       ', '.join(repr(arg) for arg in task.args)[:300])
+
+    def __work(self):
+        """ Main function of the worker threads.
+            For internal use.
+        """
+        while True:
+            task = self.queue.get()
+            if not task.cancelled:
+                with self.lock:
+                    self.active.add(task)
+                self.__call(task)
+                with self.lock:
+                    self.active.discard(task)
+            self.__finish(task)
+            if task.timed_out:
+                # another thread has taken this one's place
+                with self.lock:
+                    self.workers.remove(threading.current_thread())
+                return
+
+    def __watch(self):
+        """ Gives up on the running tasks which have timed out, and
+            logs the ones which have become slow.
+            For internal use.
+        """
+        now = time.time()
+        with self.lock:
+            tasks = [task for task in self.active
+                     if task.started is not None and not task.finished]
+        for task in tasks:
+            elapsed = now - task.started
+            timeout = self.option(task.plugin, 'timeout')
+            if timeout and elapsed > timeout:
+                self.__expire(task)
+            elif self.slow_threshold and elapsed > self.slow_threshold \
+                 and not task.reported:
+                self.__report_slow(task, 'has run for')
+
+    def __expire(self, task):
+        """ Gives up on a task that has run for too long.
+            For internal use.
+        """
+        with self.lock:
+            if task.finished:
+                return
+            task.timed_out = True
+            self.__start_worker()
+        logger.warning('Function %r of plugin %s timed out',
+                       task.function, task.plugin)
+        CALLBACK_TIMEOUTS.inc((task.plugin,))
+        task.cancel()
+        self.__finish(task)
@@ -14,42 +14,143 @@
 #    along with mib.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import select
+import errno
+import logging
+import os
 import socket
 import sys
+import time
+import weakref
+
+from batcher import OutputBatcher
+from eventloop import EventLoop
+from isupport import ISupport
+from linebuffer import LineBuffer
+import metrics
+from sendqueue import SendQueue
+from tokenbucket import TokenBucket
+
+logger = logging.getLogger('mib.socket')
+
+LINES_RECEIVED = metrics.counter('mib_lines_received_total',
+                                 'Lines read from the server')
+LINES_SENT = metrics.counter('mib_lines_sent_total',
+                             'Lines sent to the server')
+SENDQUEUE_DEPTH = metrics.gauge('mib_sendqueue_depth',
+                                'Lines waiting in the send queue')
+SOCKETS = weakref.WeakSet() # every IrcSocket, for SENDQUEUE_DEPTH
+SENDQUEUE_DEPTH.set_function(
+    lambda: sum(len(socket.sendqueue) for socket in list(SOCKETS)))
+REGISTRATION_TIME = metrics.gauge('mib_registration_seconds',
+                                  'Time from connecting to registration')
+FIRST_JOIN_TIME = metrics.gauge('mib_first_join_seconds',
+                                'Time from process start to the first join')
+LAG = metrics.gauge('mib_lag_seconds',
+                    'Round-trip time of the last lag check PING')
+RECONNECTS = metrics.counter('mib_reconnects_total',
+                             'Connections lost and tried again')
+
+# replies which mean that registration is complete
+WELCOME_REPLIES = frozenset(['001', '376', '422'])
+
+STARTED = time.time()
 
 class IrcSocket:
     """ Class for talking with an IRC server.
     """
-    def __init__(self, server, port, nick, username, realname):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    def __init__(self, server, port, nick, username, realname, loop=None,
+                 sendqueue=None, flood_control=None, capabilities=None,
+                 reconnect_delay=None, max_reconnect_delay=300,
+                 lag_interval=None, lag_timeout=None):
+        """ sendqueue is the SendQueue to use for outgoing messages.
+            flood_control is a TokenBucket that paces the sent lines,
+            one token per line.
+            capabilities is a list of IRCv3 capabilities to request
+            from the server if it has them.
+            A lost connection is made again after reconnect_delay seconds,
+            doubling the delay after each failed attempt up to
+            max_reconnect_delay. With no reconnect_delay the main loop
+            stops instead.
+            Every lag_interval seconds the server is sent a PING, and the
+            connection is dropped if nothing has been read from the server
+            in lag_timeout seconds.
+        """
+        self.sock = None
         self.server = server
         self.port = port
         self.nick = nick
         self.username = username
         self.realname = realname
-        self.connected = False
-        self.sendqueue = []
+        self.loop = loop or EventLoop()
+        self.connected = False # registration is complete
+        self.connecting = False
+        self.connect_started = None
+        self.joining = False # waiting for the first JOIN
+        self.first_join = None # seconds from start to the first JOIN
+        self.running = False
+        self.capabilities = list(capabilities or [])
+        self.enabled_capabilities = set()
+        self.offered_capabilities = set()
+        self.sendqueue = sendqueue or SendQueue()
+        self.flood_control = flood_control or TokenBucket(1, 5)
+        self.pacing_timer = None
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.backoff = reconnect_delay
+        self.reconnect_timer = None
+        self.quitting = False
+        self.lag_interval = lag_interval
+        self.lag_timeout = lag_timeout
+        self.lag_timer = None
+        self.lag_sent = None # time of the unanswered lag check PING
+        self.last_received = time.time()
+        self.isupport = ISupport()
+        self.batcher = OutputBatcher(self.isupport)
+        SOCKETS.add(self)
+        self.outbuffer = ''
+        self.inbuffer = LineBuffer()
         self.channels = set()
         self.on_channels = set()
         self.readline_cbs = set()
+        self.disconnect_cbs = set()
 
     def join(self, channel):
         """ Adds channel to the list of channels that should be joined
         """
         self.channels.add(channel)
+        if self.connected:
+            self.__join()
 
     def quit(self, reason=''):
         """ Quits the session. Reason will be sent as the quit message.
         """
         reply = 'QUIT :%s' % (reason)
+        self.quitting = True
         self.send(reply)
 
     def send(self, msg):
         """ Adds msg to the queue of messages that will be sent to server.
             msg is _not_ a PRIVMSG, but an IRC protocol message.
+            Can be called from any thread.
         """
+        if not self.loop.in_loop_thread():
+            self.loop.call_soon_threadsafe(self.send, msg)
+            return
         self.sendqueue.append(msg)
+        if self.running and not self.connecting:
+            self.loop.add_writer(self.sock, self.__send)
+
+    def send_lines(self, lines):
+        """ Adds lines with the same command and target to the queue
+            as a unit, which is sent without other lines in between.
+            Can be called from any thread.
+        """
+        if not self.loop.in_loop_thread():
+            self.loop.call_soon_threadsafe(self.send_lines, lines)
+            return
+        self.sendqueue.extend(lines)
+        if self.running and not self.connecting:
+            self.loop.add_writer(self.sock, self.__send)
 
     def register_readline_cb(self, function):
         """ Registers a callback for function to call with every read line.
@@ -58,74 +159,279 @@ class IrcSocket:
         """
         self.readline_cbs.add(function)
 
-    def __readline(self):
-        """ Reads line from the socket and strips the newline char(s).
-            Calls registered readline callbacks with the stripped line.
+    def register_disconnect_cb(self, function):
+        """ Registers a function to call without parameters
+            when the connection to the server is lost.
+        """
+        self.disconnect_cbs.add(function)
+
+    def __read(self):
+        """ Reads available data from the socket and handles every
+            complete line in it. Partial lines are kept for the next read.
+            For internal use.
+        """
+        try:
+            count = self.inbuffer.read_from(self.sock)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self.__disconnect(e)
+            return
+        if not count:
+            self.__disconnect('Connection closed by server')
+            return
+        self.last_received = time.time()
+        lines = self.inbuffer.lines()
+        LINES_RECEIVED.inc(amount=len(lines))
+        for line in lines:
+            self.__readline(line)
+
+    def __readline(self, s):
+        """ Calls registered readline callbacks with a line that
+            has been stripped from the newline char(s).
             For internal use.
         """
-        s = self.buffer.readline()
-        if s:
-            if s[-2:] == '\r\n':
-                s = s[:-2]
-            elif s[-1:] in '\r\n':
-                s = s[:-1]
-            for function in self.readline_cbs:
-                function(s)
-        return s
+        for function in self.readline_cbs:
+            function(s)
+        if s.startswith('PING'):
+            self.__handleping(s)
+        elif self.lag_sent is not None and ' PONG ' in s:
+            self.__handlepong(s)
+        if not self.connected:
+            self.__register(s)
+        elif self.joining and s.startswith(':' + self.nick + '!'):
+            self.__handlejoin(s)
 
-    def __connect(self):
-        """ Connects the socket to the server and registers the connection.
+    def __readstdin(self):
+        """ Sends a line read from stdin to the server as is.
             For internal use.
         """
-        self.sock.connect((self.server, self.port))
-        self.buffer = self.sock.makefile('r')
+        line = sys.stdin.readline()
+        if line == '':
+            self.loop.remove_reader(sys.stdin)
+            return
+        self.send(line.rstrip('\r\n'))
+
+    def connect(self):
+        """ Starts connecting to the server without waiting for the
+            connection to be made, and queues the registration messages.
+            The caller can do other work while the connection is set up;
+            run() finishes it. Called by run() if not called before.
+        """
+        logger.info('Connecting to %s:%d', self.server, self.port)
+        self.connect_started = time.time()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        try:
+            error = self.sock.connect_ex((self.server, self.port))
+        except socket.error:
+            self.sock.close() # e.g. the name could not be resolved
+            raise
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.sock.close()
+            raise socket.error(error, os.strerror(error))
+        self.connecting = True
+        self.quitting = False
+        self.loop.add_writer(self.sock, self.__connected)
+        # sent together as soon as the connection is made
+        if self.capabilities:
+            self.send('CAP LS 302')
         self.send('NICK ' + self.nick)
         self.send('USER ' + self.username + ' ' +
             socket.gethostname() + ' ' + self.server + ' :' + self.realname)
 
+    def __connected(self):
+        """ Called when the socket becomes writable after connect().
+            For internal use.
+        """
+        error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self.__disconnect(os.strerror(error))
+            return
+        logger.info('Connected to %s:%d in %.3f s', self.server, self.port,
+                    time.time() - self.connect_started)
+        self.connecting = False
+        self.loop.add_reader(self.sock, self.__read)
+        self.loop.add_writer(self.sock, self.__send)
+
     def __send(self):
-        """ Sends a message from the message queue to the server.
+        """ Writes queued messages to the socket for as long as it
+            accepts data. Called when the socket is writable.
             For internal use.
         """
-        if len(self.sendqueue) != 0:
-            msg = self.sendqueue.pop(0)
-            self.sock.send(msg + '\r\n')
+        while True:
+            if not self.outbuffer:
+                self.__fill_outbuffer()
+                if not self.outbuffer:
+                    self.loop.remove_writer(self.sock)
+                    return
+            try:
+                sent = self.sock.send(self.outbuffer)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                 errno.EINTR):
+                    return
+                self.__disconnect(e)
+                return
+            self.outbuffer = self.outbuffer[sent:]
+            if self.outbuffer:
+                return
+
+    def __fill_outbuffer(self):
+        """ Moves as many lines from the send queue to the output buffer
+            as flood control allows. Priority lines are never held back.
+            For internal use.
+        """
+        lines = []
+        while len(self.sendqueue):
+            priority = self.sendqueue.has_priority()
+            if not self.flood_control.consume(force=priority):
+                if self.pacing_timer is None:
+                    self.pacing_timer = self.loop.call_later(
+                        self.flood_control.delay(), self.__resume_sending)
+                break
+            lines.append(self.batcher.combine(self.sendqueue.pop(),
+                                              self.sendqueue))
+        if lines:
+            LINES_SENT.inc(amount=len(lines))
+            if logger.isEnabledFor(logging.DEBUG):
+                for line in lines:
+                    logger.debug('>> %s', line)
+            self.outbuffer = '\r\n'.join(lines) + '\r\n'
+
+    def __resume_sending(self):
+        """ Called when flood control allows sending again.
+            For internal use.
+        """
+        self.pacing_timer = None
+        if self.running:
+            self.loop.add_writer(self.sock, self.__send)
 
     def __join(self):
         """ Joins the channels in the channel list.
+            The JOINs are merged into as few lines as possible
+            when they are sent.
             For internal use.
         """
-        for channel in self.channels.difference(self.on_channels):
+        for channel in sorted(self.channels.difference(self.on_channels)):
             self.send('JOIN ' + channel)
             self.on_channels.add(channel)
 
+    def __disconnect(self, reason):
+        """ Closes a lost connection, forgets everything about it and
+            connects again after a delay, or stops if reconnecting
+            is disabled or we quit.
+            For internal use.
+        """
+        logger.warning('Disconnected from %s: %s', self.server, reason)
+        self.__cancel_timers()
+        self.loop.remove_reader(self.sock)
+        self.loop.remove_writer(self.sock)
+        self.sock.close()
+        self.connected = False
+        self.connecting = False
+        self.joining = False
+        self.lag_sent = None
+        self.outbuffer = ''
+        self.inbuffer = LineBuffer()
+        self.sendqueue.clear()
+        self.on_channels.clear()
+        self.isupport.reset()
+        self.offered_capabilities.clear()
+        self.enabled_capabilities.clear()
+        for function in self.disconnect_cbs:
+            function()
+        if self.quitting or self.reconnect_delay is None:
+            self.stop()
+            return
+        self.__schedule_reconnect()
+
+    def __schedule_reconnect(self):
+        """ Connects again after the current backoff delay
+            and doubles the delay for the next time.
+            For internal use.
+        """
+        RECONNECTS.inc()
+        logger.info('Reconnecting in %g s', self.backoff)
+        self.reconnect_timer = self.loop.call_later(self.backoff,
+                                                    self.__reconnect)
+        self.backoff = min(self.backoff * 2, self.max_reconnect_delay)
+
+    def __reconnect(self):
+        """ Called when it's time to connect again.
+            For internal use.
+        """
+        self.reconnect_timer = None
+        try:
+            self.connect()
+        except socket.error, e:
+            logger.warning('Unable to connect to %s: %s', self.server, e)
+            self.__schedule_reconnect()
+
+    def __check_lag(self):
+        """ Sends a lag check PING, or drops the connection if the server
+            hasn't sent anything in lag_timeout seconds.
+            For internal use.
+        """
+        now = time.time()
+        if self.lag_timeout and now - self.last_received > self.lag_timeout:
+            self.__disconnect('No data in %.1f s' %
+                              (now - self.last_received))
+            return
+        if self.lag_sent is None:
+            self.lag_sent = now
+            self.send('PING :LAG%.6f' % now)
+
+    def __cancel_timers(self):
+        """ For internal use.
+        """
+        for timer in (self.pacing_timer, self.reconnect_timer,
+                      self.lag_timer):
+            if timer:
+                timer.cancel()
+        self.pacing_timer = self.reconnect_timer = self.lag_timer = None
+
+    def stop(self):
+        """ Stops handling the connection, and the main loop if no
+            other IrcSocket is running in it.
+        """
+        self.running = False
+        self.connecting = False
+        self.__cancel_timers()
+        self.loop.remove_reader(self.sock)
+        self.loop.remove_writer(self.sock)
+        self.loop.remove_reader(sys.stdin)
+        if not any(other.running and other.loop is self.loop
+                   for other in list(SOCKETS)):
+            self.loop.stop()
+
+    def start(self, read_stdin=True):
+        """ Starts handling the connection in the loop, connecting first
+            if connect() hasn't been called. With read_stdin, lines typed
+            to stdin are sent to the server as is.
+        """
+        if not self.connecting:
+            self.connect()
+        self.running = True
+        if read_stdin:
+            self.loop.add_reader(sys.stdin, self.__readstdin)
+
     def run(self):
         """ The main loop.
+            Waits for the socket or stdin to become ready instead of
+            polling, so queued messages are sent as soon as possible.
         """
-        self.running = True
-        self.__connect()
+        self.start()
         try:
-            while self.running:
-                self.__send()
-                inputready, _, _ = select.select([sys.stdin, self.buffer],
-                                                 [], [], 0.1)
-                if sys.stdin in inputready:
-                    line = sys.stdin.readline()
-                    if line != '':
-                        self.send(line)
-                if self.buffer in inputready:
-                    line = self.__readline()
-                    if not line:
-                        self.running = False
-                        continue
-                    if line.startswith('PING'):
-                        self.__handleping(line)
-                    if line.startswith(':%s 251' %(self.server)):
-                        self.__handlelusermsg(line)
-                if (self.connected and
-                    not self.channels.issubset(self.on_channels)):
-                    self.__join()
+            self.loop.run()
         finally:
+            self.close()
+
+    def close(self):
+        """ Closes the connection after the main loop has stopped.
+        """
+        self.running = False
+        if self.sock:
             self.sock.close()
 
     def __handleping(self, line):
@@ -137,11 +443,84 @@ class IrcSocket:
         reply = 'PONG ' + pong
         self.send(reply)
 
-    def __handlelusermsg(self, line):
-        """ Handles LUSERCLIENT (251) message.
-            This is here because some irc servers don't react to
-            messages sent before the connection is properly initialized.
+    def __handlepong(self, line):
+        """ Handles the reply to a lag check PING.
+            For internal use.
+        """
+        token = line.rsplit(None, 1)[-1].lstrip(':')
+        if not token.startswith('LAG'):
+            return
+        try:
+            sent = float(token[3:])
+        except ValueError:
+            return
+        self.lag_sent = None
+        LAG.set(time.time() - sent)
+
+    def __register(self, line):
+        """ Handles the messages of connection registration:
+            capability negotiation and the welcome.
+            Channels are joined when the server has welcomed us,
+            because some irc servers don't react to messages sent before
+            the connection is properly initialized.
+            For internal use.
+        """
+        head, _, trailing = line.partition(' :')
+        parts = head.split()
+        if line.startswith(':'):
+            parts = parts[1:]
+        if not parts:
+            return
+        command = parts[0].upper()
+        if command in WELCOME_REPLIES:
+            if command == '001' and len(parts) > 1:
+                self.nick = parts[1] # the server may have changed it
+            self.connected = True
+            self.backoff = self.reconnect_delay
+            if self.lag_interval:
+                self.lag_timer = self.loop.call_every(self.lag_interval,
+                                                      self.__check_lag)
+            elapsed = time.time() - self.connect_started
+            REGISTRATION_TIME.set(elapsed)
+            logger.info('Registered to %s in %.3f s', self.server, elapsed)
+            self.joining = bool(self.channels) and self.first_join is None
+            self.__join()
+        elif command == 'CAP' and len(parts) > 2:
+            self.__handlecap(parts[2].upper(), parts[3:], trailing)
+
+    def __handlecap(self, subcommand, params, trailing):
+        """ Handles CAP LS, ACK and NAK replies.
+            Requests the wanted capabilities the server has,
+            and ends the negotiation when the server has answered.
+            For internal use.
+        """
+        if subcommand == 'LS':
+            for capability in trailing.split():
+                self.offered_capabilities.add(capability.split('=')[0])
+            if params == ['*']:
+                return # more LS lines follow
+            wanted = [capability for capability in self.capabilities
+                      if capability in self.offered_capabilities]
+            if wanted:
+                self.send('CAP REQ :' + ' '.join(wanted))
+            else:
+                self.send('CAP END')
+        elif subcommand in ('ACK', 'NAK'):
+            if subcommand == 'ACK':
+                self.enabled_capabilities.update(trailing.split())
+            logger.info('Capabilities %s: %s', subcommand, trailing)
+            self.send('CAP END')
+
+    def __handlejoin(self, line):
+        """ Records the time of the first join to a channel.
             For internal use.
         """
-        self.connected = True
+        parts = line.split(None, 2)
+        if len(parts) < 3 or parts[1].upper() != 'JOIN':
+            return
+        self.joining = False
+        elapsed = self.first_join = time.time() - STARTED
+        FIRST_JOIN_TIME.set(elapsed)
+        logger.info('Joined %s %.3f s after start',
+                    parts[2].lstrip(':'), elapsed)
 
@@ -1,9 +1,49 @@
 """ Collection of helper functions
 """
 
+import re
+
+# longest line a server sends, without the \r\n
+MAX_LINE = 510
+
 def privmsg(to, msg):
     return 'PRIVMSG %s :%s' % (to, msg)
 
+def text_budget(command, target, source):
+    """ Returns how many bytes of text fit in a message the server
+        relays as ":source command target :text".
+    """
+    return MAX_LINE - len(':%s %s %s :' % (source, command, target))
+
+def split_text(text, budget):
+    """ Returns text as a list of lines of at most budget bytes.
+        Unicode text is encoded to UTF-8. Lines are split at line
+        breaks, then at the last space that fits, or else between
+        UTF-8 characters. Empty lines are left out.
+    """
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    budget = max(budget, 4) # room for any UTF-8 character
+    pieces = []
+    for line in text.splitlines():
+        start = 0
+        while len(line) - start > budget:
+            cut = line.rfind(' ', start, start + budget + 1)
+            if cut > start:
+                pieces.append(line[start:cut])
+                start = cut + 1
+                continue
+            cut = start + budget
+            while cut > start and '\x80' <= line[cut] < '\xc0':
+                cut -= 1 # inside a UTF-8 character
+            if cut == start:
+                cut = start + budget # not UTF-8
+            pieces.append(line[start:cut])
+            start = cut
+        if start < len(line):
+            pieces.append(line[start:])
+    return pieces
+
 def join(channel):
     return 'JOIN %s' % channel
 
@@ -45,8 +85,26 @@ def unban(mask):
     return mode('-b', mask)
 
 def regexpify(mask):
-    return mask.replace('*', '.*').replace('?', '.?')
+    """ Turns an IRC mask into a regexp. * matches any number of
+        characters, ? matches one character and everything else
+        matches itself.
+    """
+    return '.*'.join('.'.join(re.escape(part) for part in piece.split('?'))
+                     for piece in mask.split('*'))
 
 def unregexpify(regexp):
-    return regexp.replace('.*', '*').replace('.?', '?')
+    """ Turns a regexp created with regexpify back into an IRC mask.
+    """
+    mask = []
+    chars = iter(regexp)
+    for char in chars:
+        if char == '\\':
+            mask.append(next(chars, ''))
+        elif char == '.':
+            mask.append('?')
+        elif char == '*':
+            mask[-1] = '*' # .* was turned into ? above
+        else:
+            mask.append(char)
+    return ''.join(mask)
 
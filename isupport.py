@@ -0,0 +1,75 @@
+""" Server features advertised with RPL_ISUPPORT (005).
+"""
+
+class ISupport:
+    """ The tokens of the server's 005 replies, with defaults for
+        servers which don't send them.
+    """
+    def __init__(self):
+        self.tokens = {} # name : value, '' for tokens without a value
+
+    def feed(self, tokens):
+        """ Adds tokens of form "NAME", "NAME=value" or "-NAME"
+            from a 005 reply.
+        """
+        for token in tokens:
+            if token.startswith('-'):
+                self.tokens.pop(token[1:], None)
+                continue
+            name, _, value = token.partition('=')
+            self.tokens[name.upper()] = value
+
+    def reset(self):
+        """ Forgets the tokens, e.g. after a disconnect.
+        """
+        self.tokens.clear()
+
+    def get(self, name, default=None):
+        return self.tokens.get(name, default)
+
+    def modes(self):
+        """ Returns the number of modes with a parameter allowed in one
+            MODE command, or None for no limit.
+        """
+        value = self.tokens.get('MODES', '3')
+        return int(value) if value.isdigit() else None
+
+    def max_targets(self, command):
+        """ Returns the number of targets allowed for command,
+            or None for no limit. JOIN and PART take several channels
+            unless the server limits them; other commands one target.
+        """
+        command = command.upper()
+        if 'TARGMAX' in self.tokens:
+            for limit in self.tokens['TARGMAX'].split(','):
+                name, _, value = limit.partition(':')
+                if name.upper() == command:
+                    return int(value) if value.isdigit() else None
+        elif command in ('PRIVMSG', 'NOTICE') and \
+             'MAXTARGETS' in self.tokens:
+            value = self.tokens['MAXTARGETS']
+            return int(value) if value.isdigit() else None
+        if command in ('JOIN', 'PART'):
+            return None
+        return 1
+
+    def chanmodes(self):
+        """ Returns a tuple of strings (list modes, modes that always take
+            a parameter, modes that take a parameter when set,
+            modes without a parameter).
+        """
+        value = self.tokens.get('CHANMODES', 'beI,k,l,imnpst')
+        groups = value.split(',') + ['', '', '', '']
+        return tuple(groups[:4])
+
+    def prefix(self):
+        """ Returns a tuple (modes, prefix characters), e.g. ('ov', '@+').
+        """
+        value = self.tokens.get('PREFIX', '(ov)@+')
+        if not value.startswith('(') or ')' not in value:
+            return ('', '')
+        modes, chars = value[1:].split(')', 1)
+        return (modes, chars)
+
+    def chantypes(self):
+        return self.tokens.get('CHANTYPES', '#&')
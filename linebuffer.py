@@ -0,0 +1,53 @@
+""" Splitting of a byte stream into lines.
+"""
+
+class LineBuffer:
+    """ Reusable receive buffer which splits incoming data into lines.
+        Lines may end with \r\n, \n or \r; empty lines are skipped.
+        Incomplete lines are kept until the rest of them arrives.
+    """
+    def __init__(self, size=16384):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.end = 0 # number of bytes in the buffer
+
+    def __grow(self):
+        """ Doubles the size of the buffer.
+            For internal use.
+        """
+        del self.view # a bytearray can't be resized while it is viewed
+        self.buffer.extend(bytearray(len(self.buffer)))
+        self.view = memoryview(self.buffer)
+
+    def read_from(self, sock):
+        """ Reads as much as fits into the buffer from sock.
+            Returns the number of bytes read, 0 means end of file.
+        """
+        if self.end == len(self.buffer):
+            self.__grow()
+        count = sock.recv_into(self.view[self.end:])
+        self.end += count
+        return count
+
+    def feed(self, data):
+        """ Adds data to the buffer.
+        """
+        while self.end + len(data) > len(self.buffer):
+            self.__grow()
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def lines(self):
+        """ Removes every complete line from the buffer and returns
+            them as a list of strings without the line endings.
+        """
+        last = max(self.buffer.rfind('\n', 0, self.end),
+                   self.buffer.rfind('\r', 0, self.end))
+        if last == -1:
+            return []
+        complete = self.view[:last + 1].tobytes()
+        rest = self.end - last - 1
+        if rest:
+            self.buffer[:rest] = self.view[last + 1:self.end]
+        self.end = rest
+        return [line for line in complete.splitlines() if line]
@@ -0,0 +1,121 @@
+""" Logging setup.
+    Every subsystem logs through its own logger under "mib":
+    "mib" for the core, "mib.socket" for the connection and
+    "mib.plugins.<plugin>" for plugins.
+    Records are handed to a background thread through a queue,
+    so the event loop never waits for the log file or the terminal.
+"""
+
+import logging
+import logging.handlers
+import Queue
+import sys
+import threading
+
+FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+class QueueHandler(logging.Handler):
+    """ Handler which puts records into a queue without blocking.
+        Records are dropped if the queue is full.
+    """
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        """ Formats the message now, so that the record no longer refers
+            to objects that might change before it is written.
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+class QueueListener(threading.Thread):
+    """ Thread which writes records from a queue with handler.
+    """
+    def __init__(self, queue, handler):
+        threading.Thread.__init__(self, name='log writer')
+        self.daemon = True
+        self.queue = queue
+        self.handler = handler
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            self.handler.handle(record)
+        self.handler.close()
+
+    def stop(self):
+        """ Writes the remaining records and stops the thread.
+        """
+        self.queue.put(None)
+        self.join()
+
+listener = None
+
+def setup(level='INFO', filename=None, max_bytes=1048576, backups=5,
+          levels=None, queue_size=10000):
+    """ Sets up logging for mib.
+        Records are written to a rotating file named filename,
+        or to stdout if filename is None.
+        level is the default level and levels is a dict of
+        logger name : level for individual subsystems.
+    """
+    global listener
+    if listener:
+        return
+    if filename:
+        handler = logging.handlers.RotatingFileHandler(
+            filename, maxBytes=max_bytes, backupCount=backups)
+    else:
+        handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(FORMAT))
+    queue = Queue.Queue(queue_size)
+    listener = QueueListener(queue, handler)
+    listener.start()
+
+    logger = logging.getLogger('mib')
+    logger.setLevel(level)
+    logger.propagate = False
+    logger.addHandler(QueueHandler(queue))
+    for name, level in (levels or {}).iteritems():
+        logging.getLogger(name).setLevel(level)
+
+def after_fork():
+    """ Starts a new writer thread in a process created with fork(),
+        which has a copy of the queue but not of the thread.
+    """
+    global listener
+    if not listener:
+        return
+    handler = listener.handler
+    handler.createLock() # it may have been held by the old thread
+    queue = Queue.Queue(listener.queue.maxsize)
+    for queue_handler in logging.getLogger('mib').handlers:
+        if isinstance(queue_handler, QueueHandler):
+            queue_handler.queue = queue
+    listener = QueueListener(queue, handler)
+    listener.start()
+
+def shutdown():
+    """ Writes the queued records and stops the writer thread.
+    """
+    global listener
+    if listener:
+        listener.stop()
+        listener = None
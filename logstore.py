@@ -0,0 +1,340 @@
+""" Channel logs with a full-text index.
+"""
+
+from array import array
+from collections import namedtuple
+import logging
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+from state import irc_lower
+import metrics
+
+logger = logging.getLogger('mib.logstore')
+
+LINES = metrics.counter('mib_logstore_lines_total',
+                        'Lines written to the channel log')
+FLUSH_TIME = metrics.histogram('mib_logstore_flush_seconds',
+                               'Time spent writing batches of log lines')
+SEARCH_TIME = metrics.histogram('mib_logstore_search_seconds',
+                                'Time spent searching the channel log')
+
+LogLine = namedtuple('LogLine', 'time network channel nick text')
+
+ASCII_WORD = re.compile(r'\w+')
+WORD = re.compile(r'\w+', re.UNICODE)
+
+def words(text):
+    """ Returns the set of lowercased words in text.
+    """
+    try:
+        text.decode('ascii')
+    except UnicodeDecodeError:
+        text = text.decode('utf-8', 'replace').lower()
+        return set(word.encode('utf-8') for word in WORD.findall(text))
+    return set(ASCII_WORD.findall(text.lower())) # the common case
+
+def nick_term(nick):
+    """ Returns the index term of the lines said by nick.
+        Words can't contain a colon, so terms never clash with words.
+    """
+    return 'nick:' + irc_lower(nick)
+
+def channel_term(network, channel):
+    """ Returns the index term of the lines said on channel.
+    """
+    return 'channel:%s %s' % (network, irc_lower(channel))
+
+def terms(line):
+    """ Returns the set of index terms of a LogLine.
+    """
+    found = words(line.text)
+    found.add(nick_term(line.nick))
+    found.add(channel_term(line.network, line.channel))
+    return found
+
+def pack(offsets):
+    """ Packs a list of line offsets in a segment into a string.
+    """
+    return array('H', offsets).tostring()
+
+def unpack(packed):
+    """ Unpacks a string made by pack into a list of offsets.
+    """
+    offsets = array('H')
+    offsets.fromstring(packed)
+    return offsets.tolist()
+
+def encode(line):
+    """ Encodes a LogLine as a line of a segment.
+    """
+    return '\t'.join((repr(line.time), line.network, line.channel,
+                      line.nick, line.text))
+
+def decode(encoded):
+    """ Decodes a line of a segment into a LogLine.
+    """
+    when, network, channel, nick, text = encoded.split('\t', 4)
+    return LogLine(float(when), network, channel, nick, text)
+
+class LogStore:
+    """ Lines said on channels, kept in an SQLite database.
+        The lines are stored in zlib compressed segments of at most
+        segment_lines (up to 65535) lines. An inverted index maps every
+        word, nick and channel to the segments it occurs in and the lines
+        of the segment that have it, so a search only decompresses the
+        segments with lines that have all of its terms, newest first,
+        until it has found enough lines. The last line of every nick is
+        kept in a table of its own.
+        add() only queues the line; a background thread saves the queued
+        lines in one transaction every flush_interval seconds. The segment
+        being filled is compressed again on every save until it is full.
+        The store can be used from several threads.
+    """
+    def __init__(self, filename, segment_lines=1000, flush_interval=1.0):
+        self.filename = filename
+        self.segment_lines = segment_lines
+        self.flush_interval = flush_interval
+        self.pending = [] # LogLines to save
+        self.saving = [] # LogLines the writer is saving
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.flushed = threading.Condition(self.lock)
+        self.urgent = False # flush() is waiting
+        self.running = True
+        self.open_id = None # segment being filled, used by the writer
+        self.open_lines = [] # its encoded lines
+        self.open_terms = {} # term : list(offset) of its lines
+        self.db_lock = threading.Lock() # for searches using self.db
+        self.db = self.__connect()
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS log_segments '
+                        '(id INTEGER PRIMARY KEY, last REAL, data BLOB)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS log_postings '
+                        '(term TEXT, segment INTEGER, lines BLOB, '
+                        'PRIMARY KEY (term, segment)) WITHOUT ROWID')
+        self.db.execute('CREATE TABLE IF NOT EXISTS log_seen '
+                        '(network TEXT, nick TEXT, time REAL, channel TEXT, '
+                        'name TEXT, text TEXT, PRIMARY KEY (network, nick))')
+        self.db.commit()
+        self.writer = threading.Thread(target=self.__write,
+                                       name='logstore writer')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def __connect(self):
+        """ Opens a connection to the database.
+            For internal use.
+        """
+        db = sqlite3.connect(self.filename, check_same_thread=False)
+        db.text_factory = str
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def add(self, network, channel, nick, text, when=None):
+        """ Queues a line nick said on channel to be saved.
+        """
+        line = LogLine(when or time.time(), network, channel, nick, text)
+        with self.lock:
+            if not self.pending:
+                self.changed.notify() # starts a new batch
+            self.pending.append(line)
+
+    def __write(self):
+        """ Main function of the writer thread.
+            For internal use.
+        """
+        db = self.__connect()
+        while True:
+            with self.lock:
+                while self.running and not self.pending:
+                    self.changed.wait()
+                if self.running and not self.urgent:
+                    # let the batch collect more lines
+                    self.changed.wait(self.flush_interval)
+                self.urgent = False
+                batch, self.pending = self.pending, []
+                self.saving = batch
+            if batch:
+                start = time.time()
+                try:
+                    self.__save(db, batch)
+                except sqlite3.Error:
+                    logger.exception('Unable to save %d lines', len(batch))
+                    self.open_id = None
+                    self.open_lines = []
+                    self.open_terms = {}
+                FLUSH_TIME.observe(time.time() - start)
+            with self.lock:
+                self.saving = []
+                self.flushed.notify_all()
+                if not self.running and not self.pending:
+                    break
+        db.close()
+
+    def __save(self, db, batch):
+        """ Writes batch in one transaction.
+            For internal use.
+        """
+        latest = {} # (network, nick) : LogLine
+        with db:
+            index = 0
+            while index < len(batch):
+                if len(self.open_lines) >= self.segment_lines:
+                    self.open_id = None
+                    self.open_lines = []
+                    self.open_terms = {}
+                room = self.segment_lines - len(self.open_lines)
+                lines = batch[index:index + room]
+                index += len(lines)
+                changed = set()
+                for line in lines:
+                    offset = len(self.open_lines)
+                    self.open_lines.append(encode(line))
+                    for term in terms(line):
+                        self.open_terms.setdefault(term, []).append(offset)
+                        changed.add(term)
+                    latest[(line.network, irc_lower(line.nick))] = line
+                data = buffer(zlib.compress('\n'.join(self.open_lines)))
+                if self.open_id is None:
+                    self.open_id = db.execute(
+                        'INSERT INTO log_segments (last, data) '
+                        'VALUES (?, ?)', (lines[-1].time, data)).lastrowid
+                else:
+                    db.execute('UPDATE log_segments SET last = ?, data = ? '
+                               'WHERE id = ?',
+                               (lines[-1].time, data, self.open_id))
+                db.executemany('INSERT OR REPLACE INTO log_postings '
+                               'VALUES (?, ?, ?)',
+                               [(term, self.open_id,
+                                 buffer(pack(self.open_terms[term])))
+                                for term in changed])
+            db.executemany('INSERT OR REPLACE INTO log_seen '
+                           'VALUES (?, ?, ?, ?, ?, ?)',
+                           [(line.network, nick, line.time, line.channel,
+                             line.nick, line.text)
+                            for (_, nick), line in latest.iteritems()])
+        LINES.inc(amount=len(batch))
+
+    def flush(self):
+        """ Waits until the queued lines have been saved.
+        """
+        with self.lock:
+            self.urgent = True
+            self.changed.notify()
+            while self.pending or self.saving:
+                self.flushed.wait(self.flush_interval)
+
+    def close(self):
+        """ Saves the queued lines and stops the writer thread.
+        """
+        with self.lock:
+            self.running = False
+            self.changed.notify()
+        self.writer.join()
+        self.db.close()
+
+    def search(self, text='', network=None, channel=None, nick=None,
+               limit=10):
+        """ Returns a list of at most limit LogLines, newest first, which
+            have every word of text and match the network, channel and
+            nick if they are given. channel needs network to be used in
+            the index.
+        """
+        start = time.time()
+        query = words(text)
+        wanted = set(query)
+        if nick:
+            wanted.add(nick_term(nick))
+        if channel and network:
+            wanted.add(channel_term(network, channel))
+
+        def matches(line):
+            return (network is None or line.network == network) and \
+                   (channel is None or
+                    irc_lower(line.channel) == irc_lower(channel)) and \
+                   (nick is None or
+                    irc_lower(line.nick) == irc_lower(nick)) and \
+                   query.issubset(words(line.text))
+
+        with self.lock:
+            recent = self.saving + self.pending
+        found = [line for line in reversed(recent) if matches(line)]
+        del found[limit:]
+        if len(found) < limit:
+            recent = set(recent) # lines being saved may be in both
+            with self.db_lock:
+                for segment, offsets in self.__candidates(wanted):
+                    row = self.db.execute('SELECT data FROM log_segments '
+                                          'WHERE id = ?',
+                                          (segment,)).fetchone()
+                    if row is None:
+                        continue
+                    encoded = zlib.decompress(row[0]).split('\n')
+                    if offsets is None:
+                        offsets = range(len(encoded))
+                    for offset in sorted(offsets, reverse=True):
+                        line = decode(encoded[offset])
+                        if line not in recent and matches(line):
+                            found.append(line)
+                            if len(found) == limit:
+                                break
+                    if len(found) == limit:
+                        break
+        SEARCH_TIME.observe(time.time() - start)
+        return found
+
+    def __candidates(self, wanted):
+        """ Yields (segment, set(offset)) for the segments with lines
+            that have every term in wanted, newest first. The offsets are
+            None if wanted is empty. The postings of each term are read
+            in order, and only until the caller stops.
+            Must be called with db_lock held.
+            For internal use.
+        """
+        if not wanted:
+            for row in self.db.execute('SELECT id FROM log_segments '
+                                       'ORDER BY id DESC'):
+                yield row[0], None
+            return
+        cursors = [self.db.execute('SELECT segment, lines FROM log_postings '
+                                   'WHERE term = ? ORDER BY segment DESC',
+                                   (term,))
+                   for term in wanted]
+        heads = [cursor.fetchone() for cursor in cursors]
+        while None not in heads:
+            segment = min(head[0] for head in heads)
+            if any(head[0] != segment for head in heads):
+                # skip the segments some of the terms aren't in
+                for index, cursor in enumerate(cursors):
+                    while heads[index] and heads[index][0] > segment:
+                        heads[index] = cursor.fetchone()
+                continue
+            offsets = set(unpack(heads[0][1]))
+            for head in heads[1:]:
+                offsets.intersection_update(unpack(head[1]))
+            if offsets:
+                yield segment, offsets
+            heads = [cursor.fetchone() for cursor in cursors]
+
+    def seen(self, network, nick):
+        """ Returns the last LogLine nick said on network, or None.
+        """
+        lowered = irc_lower(nick)
+        with self.lock:
+            recent = self.saving + self.pending
+        for line in reversed(recent):
+            if line.network == network and irc_lower(line.nick) == lowered:
+                return line
+        with self.db_lock:
+            row = self.db.execute('SELECT time, channel, name, text '
+                                  'FROM log_seen '
+                                  'WHERE network = ? AND nick = ?',
+                                  (network, lowered)).fetchone()
+        if row is None:
+            return None
+        when, channel, name, text = row
+        return LogLine(when, network, channel, name, text)
@@ -0,0 +1,99 @@
+""" Command permissions based on IRC masks.
+"""
+
+from collections import OrderedDict
+import re
+import threading
+
+# matcher of a command whose every expression has been removed
+DENY_ALL = re.compile('(?!)')
+
+class PermissionTable:
+    """ Table of regular expressions allowed to use each command.
+        All expressions of a command are compiled into a single
+        anchored matcher, and the decisions for (command, prefix)
+        pairs are kept in an LRU cache which is cleared whenever
+        the table changes.
+        Commands which have never had expressions, or whose
+        restrictions were cleared with clear(), are allowed for everyone.
+        A command whose last expression is removed is allowed for no one.
+        The table can be used from several threads.
+    """
+    def __init__(self, cache_size=4096):
+        self.patterns = {} # command : list(regexp pattern)
+        self.matchers = {} # command : compiled regexp
+        self.cache = OrderedDict() # (command, prefix) : bool
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+
+    def __contains__(self, cmd):
+        return cmd in self.patterns
+
+    def __iter__(self):
+        return iter(self.patterns.keys())
+
+    def __getitem__(self, cmd):
+        return list(self.patterns[cmd])
+
+    def add(self, cmd, pattern):
+        """ Allows prefixes matching the regexp pattern to use cmd.
+            Adding a pattern cmd already has changes nothing.
+            Raises re.error if pattern is not a valid regexp.
+        """
+        re.compile(pattern)
+        with self.lock:
+            patterns = self.patterns.setdefault(cmd, [])
+            if pattern in patterns:
+                return
+            patterns.append(pattern)
+            self.__changed(cmd)
+
+    def remove(self, cmd, pattern):
+        """ Removes pattern from cmd's list.
+            Returns True if the pattern was found.
+        """
+        with self.lock:
+            patterns = self.patterns.get(cmd, [])
+            if pattern not in patterns:
+                return False
+            patterns.remove(pattern)
+            self.__changed(cmd)
+            return True
+
+    def clear(self, cmd):
+        """ Removes the restrictions of cmd, allowing it for everyone.
+        """
+        with self.lock:
+            self.patterns.pop(cmd, None)
+            self.__changed(cmd)
+
+    def __changed(self, cmd):
+        """ Recompiles cmd's matcher and clears the decision cache.
+            Must be called with the lock held.
+            For internal use.
+        """
+        patterns = self.patterns.get(cmd)
+        if patterns:
+            union = '|'.join('(?:%s)' % pattern for pattern in patterns)
+            self.matchers[cmd] = re.compile('(?:%s)\\Z' % union, re.I)
+        elif patterns is not None:
+            self.matchers[cmd] = DENY_ALL
+        else:
+            self.matchers.pop(cmd, None)
+        self.cache.clear()
+
+    def allowed(self, cmd, prefix):
+        """ Returns True if prefix is allowed to use cmd.
+        """
+        matcher = self.matchers.get(cmd)
+        if matcher is None:
+            return True
+        key = (cmd, prefix)
+        with self.lock:
+            decision = self.cache.pop(key, None)
+            if decision is None:
+                decision = matcher.match(prefix) is not None
+                if len(self.cache) >= self.cache_size:
+                    self.cache.popitem(last=False)
+            self.cache[key] = decision
+            return decision
@@ -0,0 +1,226 @@
+""" Runtime metrics.
+    Metrics are created with counter(), gauge() and histogram(), which
+    return the existing metric if one with the same name exists.
+    render() returns every metric in the Prometheus text format, and
+    MetricsServer serves it over HTTP or a Unix socket.
+"""
+
+import BaseHTTPServer
+import bisect
+import logging
+import os
+import SocketServer
+import threading
+
+logger = logging.getLogger('mib.metrics')
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_labels(names, values, extra=''):
+    """ Returns the {name="value",...} part of a sample line.
+    """
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                          .replace('"', '\\"'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(pairs)
+
+class Metric:
+    """ Base class of the metrics. Values are kept per tuple of
+        label values, given in the order of the metric's label names.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {} # label values : value
+        self.lock = threading.Lock()
+
+    def samples(self):
+        """ Returns a list of (name suffix, label values, extra label,
+            value) tuples.
+        """
+        with self.lock:
+            return [('', key, '', value)
+                    for key, value in sorted(self.values.items())]
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, key, extra, value in self.samples():
+            lines.append('%s%s%s %r' % (self.name, suffix,
+                                        format_labels(self.labels, key,
+                                                      extra),
+                                        float(value)))
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    """ Value which only goes up.
+    """
+    kind = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, labels=()):
+        return self.values.get(labels, 0)
+
+class Gauge(Metric):
+    """ Value which can go up and down. The value can also be given
+        as a function, which is called whenever the metric is read.
+    """
+    kind = 'gauge'
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+    def set_function(self, function, labels=()):
+        self.set(function, labels)
+
+    def remove(self, labels=()):
+        with self.lock:
+            self.values.pop(labels, None)
+
+    def get(self, labels=()):
+        value = self.values.get(labels, 0)
+        return value() if callable(value) else value
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return [('', key, '', value() if callable(value) else value)
+                for key, value in items]
+
+class Histogram(Metric):
+    """ Distribution of observed values, counted into buckets.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        with self.lock:
+            data = self.values.get(labels)
+            if data is None:
+                # counts per bucket + the +Inf bucket, sum
+                data = self.values[labels] = [[0] * (len(self.buckets) + 1),
+                                              0.0]
+            data[0][bisect.bisect_left(self.buckets, value)] += 1
+            data[1] += value
+
+    def get(self, labels=()):
+        """ Returns a tuple (count, sum) of the observed values.
+        """
+        with self.lock:
+            data = self.values.get(labels)
+            if data is None:
+                return (0, 0.0)
+            return (sum(data[0]), data[1])
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            items = sorted((key, (list(data[0]), data[1]))
+                           for key, data in self.values.items())
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                samples.append(('_bucket', key, 'le="%s"' % bound,
+                                cumulative))
+            samples.append(('_sum', key, '', total))
+            samples.append(('_count', key, '', cumulative))
+        return samples
+
+metrics = {} # name : Metric
+lock = threading.Lock()
+
+def get_metric(cls, name, help, labels=(), **kwargs):
+    """ Returns the metric called name, creating it if needed.
+    """
+    with lock:
+        metric = metrics.get(name)
+        if metric is None:
+            metric = metrics[name] = cls(name, help, labels, **kwargs)
+        return metric
+
+def counter(name, help, labels=()):
+    return get_metric(Counter, name, help, labels)
+
+def gauge(name, help, labels=()):
+    return get_metric(Gauge, name, help, labels)
+
+def histogram(name, help, labels=(), buckets=LATENCY_BUCKETS):
+    return get_metric(Histogram, name, help, labels, buckets=buckets)
+
+def render():
+    """ Returns all metrics in the Prometheus text format.
+    """
+    with lock:
+        items = sorted(metrics.items())
+    return '\n'.join(metric.render() for name, metric in items) + '\n'
+
+class HTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Answers every GET request with the metrics.
+    """
+    def do_GET(self):
+        body = render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+class UnixHandler(SocketServer.StreamRequestHandler):
+    """ Writes the metrics to every connecting client.
+    """
+    def handle(self):
+        self.wfile.write(render())
+
+class ThreadingUnixServer(SocketServer.ThreadingMixIn,
+                          SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class MetricsServer:
+    """ Serves the metrics in a background thread.
+        address is either a (host, port) tuple for HTTP,
+        or a path of a Unix socket.
+    """
+    def __init__(self, address):
+        self.address = address
+        if isinstance(address, tuple):
+            self.server = ThreadingHTTPServer(address, HTTPHandler)
+        else:
+            if os.path.exists(address):
+                os.unlink(address)
+            self.server = ThreadingUnixServer(address, UnixHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='metrics server')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        logger.info('Serving metrics on %s', self.address)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if not isinstance(self.address, tuple):
+            os.unlink(self.address)
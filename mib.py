@@ -18,26 +18,120 @@
 #    along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 
+from dispatch import Dispatcher
+from eventloop import EventLoop
+from executor import Executor
 from ircsocket import IrcSocket
-from ircutils import regexpify
-from parser import parse, IRCMsg
+from logstore import LogStore
+from masks import PermissionTable
+from parser import parse
+from patterns import PatternMatcher
+from profiler import Profiler
+from ratelimit import RateLimiter
+from responsecache import CachedCommand, ResponseCache
+from state import State, UPDATERS, irc_lower
+from storage import PluginStorage, Storage
+from sendqueue import SendQueue
+from tokenbucket import TokenBucket
+from workers import Remote, WorkerPool
 import config
+import ircutils
+import log
+import metrics
 
+from collections import OrderedDict
+import logging
 import os
-import re
 import sys
+import threading
+import time
+import weakref
+
+logger = logging.getLogger('mib')
+
+PARSE_FAILURES = metrics.counter('mib_parse_failures_total',
+                                 'Lines which could not be parsed')
+PERMISSION_CHECK = metrics.histogram('mib_permission_check_seconds',
+                                     'Time spent checking permissions')
+RATE_LIMITED = metrics.counter('mib_rate_limited_total',
+                               'Commands dropped by rate limiting')
+
+# the settings a network in config.NETWORKS can change
+NETWORK_SETTINGS = ('SERVER', 'NICK', 'USERNAME', 'REALNAME', 'CHANNELS',
+                    'CAPABILITIES')
+# name of the network when config.NETWORKS is not set
+DEFAULT_NETWORK = 'default'
+
+def network_settings():
+    """ Returns a list of (name, dict of settings) of the networks in
+        config, sorted by name. Settings a network doesn't have are
+        taken from the top level of config.
+    """
+    defaults = dict((key, getattr(config, key)) for key in NETWORK_SETTINGS)
+    networks = config.NETWORKS or {DEFAULT_NETWORK: {}}
+    settings = []
+    for name in sorted(networks):
+        unknown = set(networks[name]).difference(NETWORK_SETTINGS)
+        if unknown:
+            raise ValueError('Unknown settings for network %s: %s' %
+                             (name, ', '.join(sorted(unknown))))
+        network = dict(defaults)
+        network.update(networks[name])
+        settings.append((name, network))
+    return settings
+
+class Network:
+    """ A connection to one IRC network and what is known about it.
+    """
+    def __init__(self, name, socket):
+        self.name = name
+        self.socket = socket
+        self.state = State(socket.nick)
+
+    def source(self):
+        """ Returns the bot's nick!user@host as the server relays it,
+            or the longest one the server allows until it is known.
+        """
+        source = self.state.source()
+        if source is None:
+            isupport = self.socket.isupport
+            def length(name, default):
+                try:
+                    return int(isupport.get(name, default))
+                except ValueError:
+                    return default
+            # the username may get a ~ in front of it
+            source = '%s!%s@%s' % (self.state.nick,
+                                   'u' * (length('USERLEN', 10) + 1),
+                                   'h' * length('HOSTLEN', 63))
+        return source
 
 class Mib:
     """ Main class which handles most of the core functionality.
     """
-    def __init__(self):
+    def __init__(self, socket=None, network=DEFAULT_NETWORK):
         """ Initialize variables and read config.
+            socket replaces the IrcSocket in worker processes,
+            and network is the name of its network.
         """
         sys.path.append('plugins')
         self.loaded_plugins = {} # plugin name : module
-        self.cmd_callbacks = {} # command : set(function)
-        self.privmsg_cmd_callbacks = {} # command : set(function)
-        self.command_masks = {} # command : list(regexp)
+        self.plugin_params = {} # plugin name : params
+        self.lazy_commands = {} # privmsg command : plugin name
+        self.cmd_callbacks = Dispatcher(self.__submit)
+        self.privmsg_cmd_callbacks = Dispatcher(self.__submit)
+        self.privmsg_patterns = PatternMatcher()
+        self.response_cache = ResponseCache(config.RESPONSE_CACHE_SIZE)
+        self.timers = {} # plugin : WeakSet(Timer)
+        self.command_masks = PermissionTable() # command : list(regexp)
+        self.rate_limiter = RateLimiter(config.RATE_LIMIT_USER,
+                                        config.RATE_LIMIT_CHANNEL,
+                                        config.COMMAND_COSTS,
+                                        config.RATE_LIMIT_BUCKETS,
+                                        self.__chantypes)
+        self.privmsg_cmd_callbacks.add_middleware(self.__check_rate_limit)
+        self.privmsg_cmd_callbacks.add_middleware(self.__check_permission)
+        self.privmsg_cmd_callbacks.add_middleware(self.__log_command)
 
         self.plugins = set(config.LOAD_PLUGINS)
         self.cmd_prefixes = set(config.CMD_PREFIXES)
@@ -46,67 +140,370 @@ class Mib:
         self.realname = config.REALNAME
         self.server, self.port = config.SERVER
         self.channels = config.CHANNELS
-        self.socket = IrcSocket(self.server, self.port, self.nick,
-                                self.username, self.realname)
-        self.socket.register_readline_cb(self.parse_line)
-        for channel in self.channels:
-            self.socket.join(channel)
+        self.networks = OrderedDict() # name : Network
+        self.current = threading.local() # network of the running callback
+        self.workers = None
+        self.in_worker = worker = socket is not None
+        self.loop = socket.loop if worker else EventLoop()
+        if worker:
+            self.__add_network(network, socket)
+        else:
+            for name, settings in network_settings():
+                self.__add_network(name, self.__create_socket(settings))
+        self.default_network = self.networks.keys()[0]
+        if config.WORKER_PROCESSES and not worker:
+            if len(self.networks) > 1:
+                raise ValueError('WORKER_PROCESSES can only be used '
+                                 'with one network')
+            # forks the fork server, so before any threads are started
+            self.workers = WorkerPool(self, config.WORKER_PROCESSES,
+                                      self.__make_worker)
+        self.executor = Executor(self.loop, config.EXECUTOR_THREADS,
+                                 config.CALLBACK_TIMEOUT,
+                                 set_context=self.__set_network,
+                                 slow_threshold=config.SLOW_CALLBACK)
+        for plugin, options in config.PLUGIN_EXECUTOR.iteritems():
+            self.executor.configure(plugin, **options)
+        self.executor.configure(__name__, inline=True)
+        # the state must be up to date before plugins look at it
+        for cmd in UPDATERS:
+            self.register_cmd(cmd, self.__update_state, priority=-1)
+        self.register_cmd('005', self.handle_isupport)
+        self.logstore = None
+        self.storage_backend = None # opened on first use
+        self.storage_lock = threading.Lock()
+        if worker:
+            # the connection process queries modes, logs and stores
+            if config.LOGSTORE_FILE:
+                self.logstore = Remote(socket, 'logstore')
+        else:
+            self.register_cmd('JOIN', self.__query_modes)
+            if config.LOGSTORE_FILE:
+                self.logstore = LogStore(config.LOGSTORE_FILE,
+                                         config.LOGSTORE_SEGMENT_LINES,
+                                         config.LOGSTORE_FLUSH_INTERVAL)
+                self.register_cmd('PRIVMSG', self.__log_message)
+        if self.workers:
+            self.workers.serve('storage', self.__storage_backend)
+            self.workers.serve('logstore', lambda: self.logstore)
+        self.profiler = Profiler(self.loop, config.PROFILE_DIRECTORY,
+                                 config.PROFILE_SAMPLE_INTERVAL)
+        self.metrics_server = None
+        if config.METRICS_ADDRESS and not worker:
+            self.metrics_server = metrics.MetricsServer(
+                config.METRICS_ADDRESS)
+
+    def __create_socket(self, settings):
+        """ Creates the IrcSocket of a network.
+            For internal use.
+        """
+        server, port = settings['SERVER']
+        socket = IrcSocket(server, port, settings['NICK'],
+                           settings['USERNAME'], settings['REALNAME'],
+                           loop=self.loop,
+                           sendqueue=SendQueue(config.SENDQ_SIZE),
+                           flood_control=TokenBucket(config.SEND_RATE,
+                                                     config.SEND_BURST),
+                           capabilities=settings['CAPABILITIES'],
+                           reconnect_delay=config.RECONNECT_DELAY,
+                           max_reconnect_delay=config.RECONNECT_MAX_DELAY,
+                           lag_interval=config.LAG_CHECK_INTERVAL,
+                           lag_timeout=config.LAG_TIMEOUT)
+        for channel in settings['CHANNELS']:
+            socket.join(channel)
+        return socket
+
+    def __add_network(self, name, socket):
+        """ Adds a network whose lines are read from socket.
+            For internal use.
+        """
+        self.networks[name] = Network(name, socket)
+        socket.register_readline_cb(
+            lambda line: self.parse_line(line, name))
+        socket.register_disconnect_cb(lambda: self.handle_disconnect(name))
+
+    def __set_network(self, network):
+        """ Sets the network of the callback the executor is about to
+            run in this thread.
+            For internal use.
+        """
+        self.current.network = network
+
+    def network(self, name=None):
+        """ Returns the Network called name, or the network of the
+            message being handled if name is None. Outside callbacks
+            that is the first network.
+        """
+        if name is None:
+            name = getattr(self.current, 'network', None) or \
+                   self.default_network
+        return self.networks[name]
+
+    @property
+    def socket(self):
+        """ The IrcSocket of the network of the message being handled,
+            so replies go back where the message came from.
+        """
+        return self.network().socket
+
+    @property
+    def state(self):
+        """ The State of the network of the message being handled.
+        """
+        return self.network().state
+
+    def say(self, target, text, network=None, notice=False):
+        """ Sends text, a string or a list of lines, to target on
+            network, or the network of the message being handled,
+            as PRIVMSGs or as NOTICEs if notice is True.
+            Lines too long for the server to relay with the bot's own
+            nick!user@host are split, and the lines are queued as a unit
+            which is sent without other lines in between.
+            Unicode text is sent encoded as UTF-8.
+        """
+        network = self.network(network)
+        command = 'NOTICE' if notice else 'PRIVMSG'
+        if isinstance(text, basestring):
+            text = [text]
+        budget = ircutils.text_budget(command, target, network.source())
+        head = '%s %s :' % (command, target)
+        lines = []
+        for part in text:
+            lines.extend(head + piece
+                         for piece in ircutils.split_text(part, budget))
+        network.socket.send_lines(lines)
+
+    def load_plugins(self):
+        """ Loads the plugins in config, or makes them load on first use
+            if they are in the manifest.
+        """
+        manifest = self.read_manifest()
         for plugin in self.plugins:
-            print self.load_plugin(plugin)[1]
+            if plugin in manifest:
+                for cmd in manifest[plugin]:
+                    self.lazy_commands[cmd] = plugin
+                logger.info('Plugin %s will be loaded on first use', plugin)
+            else:
+                logger.info('%s', self.load_plugin(plugin)[1])
 
     def run(self):
         """ Start socket's main loop.
+            Plugins are loaded while the connection to the server
+            is being made, or by the worker processes.
+        """
+        if self.workers:
+            self.workers.start() # before the socket exists
+        if self.metrics_server:
+            self.metrics_server.start()
+        sockets = [network.socket for network in self.networks.values()]
+        for socket in sockets:
+            socket.connect()
+        if not self.workers:
+            self.load_plugins()
+        for socket in sockets:
+            socket.start(read_stdin=socket is sockets[0])
+        try:
+            self.loop.run()
+        finally:
+            for socket in sockets:
+                socket.close()
+
+    def __make_worker(self, socket):
+        """ Creates the Mib of a worker process.
+            For internal use.
         """
-        self.socket.run()
+        mib = self.__class__(socket, self.default_network)
+        socket.register_restore_cb(mib.state.restore)
+        return mib
 
     def clean(self):
+        if self.workers:
+            self.workers.stop()
         for plugin in self.loaded_plugins.itervalues():
             plugin.clean()
+        if self.storage_backend:
+            self.storage_backend.close()
+        if self.logstore and not self.in_worker:
+            self.logstore.close()
+        if self.metrics_server:
+            self.metrics_server.stop()
+
+    def storage(self, plugin):
+        """ Returns a PluginStorage, a persistent dict-like store
+            of plugin's own keys. Values must be encodable as JSON.
+            Writes are saved in the background. In a worker process
+            the storage of the connection process is used.
+        """
+        if self.in_worker:
+            return PluginStorage(Remote(self.socket, 'storage'), plugin)
+        return PluginStorage(self.__storage_backend(), plugin)
 
-    def parse_line(self, line):
-        """ Parse line and call callbacks registered for command.
+    def __storage_backend(self):
+        """ Returns the Storage, opening it on first use.
+            For internal use.
         """
-        print line
+        # plugins may ask for their storage from several threads at once
+        with self.storage_lock:
+            if self.storage_backend is None:
+                self.storage_backend = Storage(config.STORAGE_FILE,
+                                               config.STORAGE_CACHE_SIZE,
+                                               config.STORAGE_FLUSH_INTERVAL)
+            return self.storage_backend
+
+    def parse_line(self, line, network=None):
+        """ Parse line read from network and call callbacks registered
+            for command. network defaults to the first network.
+        """
+        trace = logger.isEnabledFor(logging.DEBUG)
+        if trace:
+            logger.debug('<< %s', line)
         parsed = parse(line)
         if not parsed:
-            print 'Unable to parse line: "%s"' %(line)
+            PARSE_FAILURES.inc()
+            logger.warning('Unable to parse line: "%s"', line)
             return
+        parsed.network = network or self.default_network
         # call registered functions
-        for function in self.cmd_callbacks.get(parsed.cmd, ()):
-            try:
-                function(parsed)
-            except Exception, e:
-                print 'Error from function', repr(function), ':', e
+        self.cmd_callbacks.dispatch(parsed.cmd, parsed)
         # call registered privmsg functions with pre-parsed line
         if parsed.cmd == 'PRIVMSG':
-            cmd_prefix = parsed.postfix.split(' ', 1)[0]
-            postfix = parsed.postfix[len(cmd_prefix):].lstrip()
-            if cmd_prefix in self.cmd_prefixes:
-                print 'Found command prefix', cmd_prefix
-                cmd = postfix.lstrip().split(' ', 1)[0]
-                postfix = postfix[len(cmd):].lstrip()
-                stripped_parsed = IRCMsg(parsed.prefix, parsed.cmd,
-                                         parsed.params, postfix)
-                print "stripped_parsed = ", stripped_parsed
-                print 'Searching for command', cmd
-                for function in self.privmsg_cmd_callbacks.get(cmd, ()):
-                    run = False
-                    if cmd not in self.command_masks:
-                        run = True
-                    else:
-                        print 'There are limitations for this command'
-                        for regexp in self.command_masks[cmd]:
-                            print 'Matching %s to %s' % (parsed.prefix,
-                                                         regexp.pattern)
-                            if regexp.match(parsed.prefix):
-                                run = True
-                                break
-                    if run:
-                        try:
-                            print 'Executing command %s' % cmd
-                            function(stripped_parsed)
-                        except Exception, e:
-                            print 'Error from function', repr(function), ':', e
+            if self.privmsg_patterns:
+                self.__dispatch_patterns(parsed)
+            command = parsed.split_command(self.cmd_prefixes)
+            if command:
+                cmd, postfix = command
+                if cmd in self.lazy_commands:
+                    plugin = self.lazy_commands[cmd]
+                    logger.info('%s', self.load_plugin(plugin)[1])
+                stripped_parsed = parsed._replace(postfix=postfix)
+                if trace:
+                    logger.debug('Searching for command %s in %r',
+                                 cmd, stripped_parsed)
+                self.privmsg_cmd_callbacks.dispatch(cmd, stripped_parsed)
+
+    def __submit(self, function, msg):
+        """ Calls function with msg in the executor. Messages to the
+            same target are kept in order for ordered plugins.
+            For internal use.
+        """
+        key = msg.middle[0] if msg.middle else ''
+        self.executor.submit(function.__module__, function, msg, key,
+                             msg.network)
+
+    def __check_rate_limit(self, cmd, msg):
+        """ Middleware which drops commands over the rate limits.
+            For internal use.
+        """
+        if self.rate_limiter.allow(cmd, msg):
+            return True
+        RATE_LIMITED.inc()
+        logger.debug('Rate limited %s from %s', cmd, msg.prefix)
+        return False
+
+    def __check_permission(self, cmd, msg):
+        """ Middleware which drops commands the sender may not use.
+            For internal use.
+        """
+        start = time.time()
+        allowed = self.command_masks.allowed(cmd, msg.prefix)
+        PERMISSION_CHECK.observe(time.time() - start)
+        if not allowed:
+            logger.debug('%s is not allowed to use %s', msg.prefix, cmd)
+        return allowed
+
+    def __log_command(self, cmd, msg):
+        """ Middleware which logs the commands that are executed.
+            For internal use.
+        """
+        logger.debug('Executing command %s', cmd)
+        return True
+
+    def __dispatch_patterns(self, msg):
+        """ Calls the functions whose patterns are found in msg.
+            For internal use.
+        """
+        key = msg.middle[0] if msg.middle else ''
+        for function, match in self.privmsg_patterns.match(msg.postfix):
+            self.executor.call(function.__module__, function, (msg, match),
+                               key, msg.network)
+
+    def call_later(self, delay, function, *args):
+        """ Calls function(*args) after delay seconds.
+            The call is run like the plugin's other callbacks, on the
+            network of the message being handled when it was scheduled.
+            Returns a Timer that can be given to cancel().
+            Can be called from any thread.
+        """
+        plugin = function.__module__
+        timer = self.loop.call_later(delay, self.executor.call,
+                                     plugin, function, args, None,
+                                     self.network().name)
+        self.timers.setdefault(plugin, weakref.WeakSet()).add(timer)
+        return timer
+
+    def call_every(self, interval, function, *args):
+        """ Calls function(*args) every interval seconds until the
+            returned Timer is given to cancel(), or the plugin is unloaded.
+            Can be called from any thread.
+        """
+        plugin = function.__module__
+        timer = self.loop.call_every(interval, self.executor.call,
+                                     plugin, function, args, None,
+                                     self.network().name)
+        self.timers.setdefault(plugin, weakref.WeakSet()).add(timer)
+        return timer
+
+    def cancel(self, timer):
+        """ Cancels a call scheduled with call_later or call_every.
+        """
+        timer.cancel()
+
+    def handle_disconnect(self, network):
+        """ Forgets the channels of network when the connection
+            is lost.
+        """
+        self.networks[network].state.reset()
+
+    def __update_state(self, msg):
+        """ Updates the state of the network msg came from.
+            For internal use.
+        """
+        self.networks[msg.network].state.update(msg)
+
+    def __query_modes(self, msg):
+        """ Asks the modes of the channels the bot has joined.
+            The reply (324) updates the state.
+            For internal use.
+        """
+        network = self.networks[msg.network]
+        if not msg.args or not msg.prefix or \
+           irc_lower(msg.source.nick) != irc_lower(network.state.nick):
+            return
+        for channel in msg.args[0].split(','):
+            network.socket.send('MODE ' + channel)
+
+    def __log_message(self, msg):
+        """ Adds a message sent to a channel to the log store.
+            For internal use.
+        """
+        if not msg.middle or not msg.prefix:
+            return
+        channel = msg.middle[0]
+        isupport = self.networks[msg.network].socket.isupport
+        if channel[:1] in isupport.chantypes():
+            self.logstore.add(msg.network, channel, msg.source.nick,
+                              msg.postfix)
+
+    def handle_isupport(self, msg):
+        """ Handles RPL_ISUPPORT (005) message.
+            Stores the server's limits for the output batcher and
+            tells the state tracker which modes the server has.
+        """
+        network = self.networks[msg.network]
+        isupport = network.socket.isupport
+        isupport.feed(msg.middle[1:])
+        network.state.set_prefix(*isupport.prefix())
+        network.state.set_chanmodes(*isupport.chanmodes()[:3])
 
     def load_plugin(self, plugin, params=None):
         """ str, ([]) -> (bool, str)
@@ -121,6 +518,9 @@ class Mib:
         if not os.path.exists(os.path.join('plugins', plugin + '.py')):
             return (False, 'Plugin %s does not exists' %(plugin))
 
+        for cmd, name in self.lazy_commands.items():
+            if name == plugin:
+                del self.lazy_commands[cmd]
         try:
             module = __import__(plugin)
             if params:
@@ -128,42 +528,163 @@ class Mib:
             else:
                 obj = module.init(self)
             success = True
-        except Exception, err:
+        except Exception:
             success = False
-            print err
+            logger.exception('Error while loading plugin %s', plugin)
 
         if success:
             self.loaded_plugins[plugin] = obj
+            self.plugin_params[plugin] = params
             return (True, 'Loaded plugin %s' %(plugin))
         else:
+            self.unregister_plugin(plugin)
+            sys.modules.pop(plugin, None)
             return (False, 'Failed to load plugin %s' %(plugin))
 
-    def register_cmd(self, cmd, function):
+    def unload_plugin(self, plugin):
+        """ str -> (bool, str)
+
+            Cleans up plugin and removes its registered functions.
+            Returns a tuple with a boolean stating if the plugin
+            was unloaded and a message telling what happened.
+        """
+        if plugin not in self.loaded_plugins:
+            return (False, 'Plugin %s is not loaded' %(plugin))
+        obj = self.loaded_plugins.pop(plugin)
+        try:
+            obj.clean()
+        except Exception:
+            logger.exception('Error while cleaning plugin %s', plugin)
+        self.unregister_plugin(plugin)
+        # forget the module, so that the next load imports it again
+        sys.modules.pop(plugin, None)
+        return (True, 'Unloaded plugin %s' %(plugin))
+
+    def reload_plugin(self, plugin):
+        """ str -> (bool, str)
+
+            Unloads plugin and loads it again from its file with
+            the params it was loaded with.
+        """
+        params = self.plugin_params.get(plugin)
+        succ, msg = self.unload_plugin(plugin)
+        if not succ:
+            return (succ, msg)
+        succ, msg = self.load_plugin(plugin, params)
+        if succ:
+            return (True, 'Reloaded plugin %s' %(plugin))
+        return (succ, msg)
+
+    def unregister_plugin(self, plugin):
+        """ Removes every function defined in plugin's module
+            from the registered functions.
+        """
+        self.cmd_callbacks.remove_module(plugin)
+        self.privmsg_cmd_callbacks.remove_module(plugin)
+        self.privmsg_patterns.remove_module(plugin)
+        self.response_cache.remove_module(plugin)
+        for timer in list(self.timers.pop(plugin, ())):
+            timer.cancel()
+
+    def read_manifest(self):
+        """ Reads plugins/manifest.cfg.
+            Each line is of form "plugin command [command ...]" and lists
+            the privmsg commands a plugin registers. Such plugins are only
+            loaded when one of the commands is used for the first time.
+            Returns a dict of plugin : list(command).
+        """
+        manifest = {}
+        try:
+            f = open(os.path.join('plugins', 'manifest.cfg'))
+        except IOError:
+            return manifest
+
+        try:
+            for line in f:
+                line = line.split('#', 1)[0].split()
+                if len(line) < 2:
+                    continue
+                manifest[line[0]] = line[1:]
+        finally:
+            f.close()
+        return manifest
+
+    def register_cmd(self, cmd, function, priority=0):
         """ Registers a function to be called when a line with
-            cmd is seen. Function must take one named tuple parameter.
-            Tuple contains line in parsed form with fields
+            cmd is seen, or every line if cmd is '*'.
+            Function must take one IRCMsg parameter.
+            IRCMsg contains line in parsed form with fields
             (prefix, cmd, params, postfix)
+            Functions with a smaller priority are called first.
         """
-        self.cmd_callbacks.setdefault(cmd, set()).add(function)
+        self.cmd_callbacks.register(cmd, function, priority)
 
-    def register_privmsg_cmd(self, cmd, function):
+    def register_privmsg_cmd(self, cmd, function, priority=0,
+                             cache_ttl=None, per_channel=False):
         """ Registers a function to be called when a PRIVMSG with
-            cmd is seen. Function must take one named tuple parameter.
-            Tuple contains line in parsed form with fields
+            cmd is seen, or every command if cmd is '*'.
+            Function must take one IRCMsg parameter.
+            IRCMsg contains line in parsed form with fields
             (prefix, cmd, params,
             postfix stripped from one of CMD_PREFIXES and cmd)
+            Functions with a smaller priority are called first.
+            If cache_ttl is given, function must return its reply, a
+            string or a list of lines, which is sent to the channel or
+            the user the command came from and given again for the same
+            arguments for cache_ttl seconds. With per_channel, replies
+            are cached for each channel separately.
+        """
+        if cache_ttl is not None:
+            function = CachedCommand(cmd, function, cache_ttl, per_channel,
+                                     self.response_cache, self.say,
+                                     self.__chantypes)
+        self.privmsg_cmd_callbacks.register(cmd, function, priority)
+
+    def __chantypes(self, network):
+        """ For internal use.
         """
-        self.privmsg_cmd_callbacks.setdefault(cmd, set()).add(function)
+        return self.networks[network].socket.isupport.chantypes()
+
+    def register_privmsg_pattern(self, pattern, function, regexp=False):
+        """ Registers a function to be called when pattern is found
+            anywhere in a PRIVMSG. pattern is a keyword, matched
+            case-insensitively, or a regular expression if regexp is True.
+            Function must take two parameters: the IRCMsg and the match,
+            which is the keyword or the match object of the expression.
+            Raises re.error if pattern is not a valid regexp.
+        """
+        if regexp:
+            self.privmsg_patterns.add_regexp(pattern, function)
+        else:
+            self.privmsg_patterns.add_keyword(pattern, function)
+
+    def unregister_cmd(self, cmd, function):
+        """ Removes a function registered with register_cmd.
+        """
+        self.cmd_callbacks.unregister(cmd, function)
+
+    def unregister_privmsg_cmd(self, cmd, function):
+        """ Removes a function registered with register_privmsg_cmd.
+        """
+        self.privmsg_cmd_callbacks.unregister(cmd, function)
+
+    def unregister_privmsg_pattern(self, pattern, function, regexp=False):
+        """ Removes a function registered with register_privmsg_pattern.
+        """
+        if regexp:
+            self.privmsg_patterns.remove_regexp(pattern, function)
+        else:
+            self.privmsg_patterns.remove_keyword(pattern, function)
 
     def add_cmd_permission(self, cmd, mask, regexpify=True):
         """ Creates a regular expression from the mask and adds it
             to the list of allowed regexps for the cmd.
             mask is an IRC mask, and will be changed into a corresponding
-            regular expression.
+            regular expression, unless regexpify is False.
         """
-        mask = regexpify(mask)
-        m = re.compile(mask)
-        self.command_masks.setdefault(cmd, []).append(m)
+        if regexpify:
+            mask = ircutils.regexpify(mask)
+        self.command_masks.add(cmd, mask)
 
     def rm_cmd_permission(self, cmd, mask):
         """ Creates a regular expression from the mask, and removes
@@ -171,21 +692,26 @@ class Mib:
             mask is an IRC mask, and will be changed into a corresponding
             regular expression.
         """
-        mask = regexpify(mask)
-        if cmd in self.command_masks:
-            for index, regexp in enumerate(self.command_masks[cmd]):
-                if regexp.pattern == mask:
-                    del self.command_masks[cmd][index]
-                    break
+        self.command_masks.remove(cmd, ircutils.regexpify(mask))
+
+    def clear_cmd_permissions(self, cmd):
+        """ Removes every restriction of cmd, so that everyone can
+            use it. Removing the masks one by one leaves the command
+            usable by no one.
+        """
+        self.command_masks.clear(cmd)
 
 if __name__ == "__main__":
+    log.setup(config.LOG_LEVEL, config.LOG_FILE, config.LOG_MAX_BYTES,
+              config.LOG_BACKUPS, config.LOG_LEVELS)
     mib = Mib()
     try:
         mib.run()
-    except Exception, e:
-        print 'ERROR: ', e
+    except Exception:
+        logger.exception('ERROR')
     except:
         pass
     mib.clean()
-    print 'Quiting!'
+    logger.info('Quiting!')
+    log.shutdown()
 
@@ -1,46 +1,167 @@
 from collections import namedtuple
 
-IRCMsg = namedtuple('IRCMsg', 'prefix cmd params postfix')
 Prefix = namedtuple('Prefix', 'nick user host')
 
-def parse(line):
-    """ Parses line and returns a named tuple IRCMsg
-        with fields (prefix, cmd, params, postfix).
-        - prefix is the first part starting with : (colon), without the :
+TAG_ESCAPES = {':': ';', 's': ' ', 'r': '\r', 'n': '\n', '\\': '\\'}
+
+class IRCMsg(object):
+    """ A parsed IRC message with fields (prefix, cmd, params, postfix).
+        - prefix is the part starting with : (colon), without the :
         - cmd is the command
-        - params are the parameters for the command,
+        - params are the parameters for the command separated by spaces,
           not including the possible postfix
-        - postfix is the part of the parameters starting with :, without the :
+        - postfix is the trailing parameter starting with :, without the :
+        The rest of the fields are computed on first use and cached:
+        - tags is a dict of IRCv3 message tags
+        - source is the prefix parsed into a Prefix named tuple
+        - args is a list of all parameters, including the postfix
+        network is the name of the network the message came from.
+    """
+    __slots__ = ('prefix', 'cmd', 'middle', 'postfix', 'trailing',
+                 'network', '_tags', '_source', '_params', '_command')
+
+    def __init__(self, prefix, cmd, middle, postfix, trailing=True, tags=''):
+        self.prefix = prefix
+        self.cmd = cmd
+        self.middle = middle # list of parameters before the postfix
+        self.postfix = postfix
+        self.trailing = trailing # True if the line had a postfix
+        self.network = None
+        self._tags = tags
+        self._source = None
+        self._params = None
+        self._command = None
+
+    @property
+    def tags(self):
+        if not isinstance(self._tags, dict):
+            self._tags = parse_tags(self._tags)
+        return self._tags
+
+    @property
+    def source(self):
+        if self._source is None:
+            self._source = parse_prefix(self.prefix)
+        return self._source
+
+    @property
+    def params(self):
+        if self._params is None:
+            self._params = ' '.join(self.middle)
+        return self._params
+
+    @property
+    def args(self):
+        if self.trailing:
+            return self.middle + [self.postfix]
+        return list(self.middle)
+
+    def split_command(self, cmd_prefixes):
+        """ set(str) -> (str, str) or None
+
+            Splits a postfix of form "<cmd prefix> <command> <argument>"
+            into a tuple (command, argument). Returns None if the postfix
+            doesn't start with one of cmd_prefixes.
+            The result is cached, so cmd_prefixes should always be the same.
+        """
+        if self._command is None:
+            words = self.postfix.split(None, 1)
+            if words and words[0] in cmd_prefixes:
+                words = words[1].split(None, 1) if len(words) == 2 else []
+                words.extend(('', ''))
+                self._command = (words[0], words[1])
+            else:
+                self._command = False
+        return self._command or None
+
+    def _replace(self, **kwargs):
+        """ Returns a copy of the message with the given fields replaced.
+        """
+        msg = IRCMsg.__new__(IRCMsg)
+        for name in IRCMsg.__slots__:
+            setattr(msg, name, kwargs.get(name, getattr(self, name)))
+        if 'middle' in kwargs:
+            msg._params = None
+        if 'postfix' in kwargs:
+            msg._command = None
+        return msg
+
+    def __repr__(self):
+        return 'IRCMsg(prefix=%r, cmd=%r, params=%r, postfix=%r)' % (
+            self.prefix, self.cmd, self.params, self.postfix)
+
+def parse(line):
+    """ Parses line and returns an IRCMsg, or None if the line
+        is not a valid IRC message.
+        Lines may start with IRCv3 message tags.
     """
     if not line:
         return None
+    tags = ''
     prefix = ''
-    command = ''
-    params = ''
     postfix = ''
 
-    # prefix is present is line starts with ':'
-    if line[0] == ':':
-        prefix, line = line.split(' ', 1)
-    
-    # there might be more than one space between
-    # the possible prefix and command, so we'll strip them
-    command, line = line.lstrip().split(' ', 1)
-    
-    # postfix is present is line has ':'
-    index = line.find(':')
-    if index != -1:
-        params = line[:index]
-        postfix = line[index:]
-    else:
-        params = line
+    # tags are present if line starts with '@'
+    if line[0] == '@':
+        tags, _, line = line.partition(' ')
+        tags = tags[1:]
+        line = line.lstrip(' ')
+
+    # prefix is present if line starts with ':'
+    if line[:1] == ':':
+        prefix, _, line = line.partition(' ')
+        prefix = prefix[1:]
+
+    # postfix starts from the first parameter starting with ':'
+    index = line.find(' :')
+    trailing = index != -1
+    if trailing:
+        postfix = line[index + 2:]
+        line = line[:index]
+
+    # there might be more than one space between the parameters
+    middle = line.split()
 
     # command must be non-empty
-    if len(command) == 0:
+    if not middle:
         return None
 
-    return IRCMsg(prefix=prefix[1:], cmd=command, params=params,
-                  postfix=postfix[1:])
+    return IRCMsg(prefix, middle[0], middle[1:], postfix, trailing, tags)
+
+def parse_many(lines):
+    """ Parses every line in lines.
+        Returns a list of IRCMsgs with None in place of invalid lines.
+    """
+    return [parse(line) for line in lines]
+
+def parse_tags(tags):
+    """ Parses IRCv3 message tags of form "key=value;key2" into a dict.
+        Keys without a value get an empty string as the value.
+    """
+    result = {}
+    if not tags:
+        return result
+    for tag in tags.split(';'):
+        key, _, value = tag.partition('=')
+        if '\\' in value:
+            value = unescape_tag_value(value)
+        result[key] = value
+    return result
+
+def unescape_tag_value(value):
+    """ Removes the escaping from an IRCv3 tag value.
+    """
+    chars = []
+    escaped = False
+    for char in value:
+        if escaped:
+            chars.append(TAG_ESCAPES.get(char, char))
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        else:
+            chars.append(char)
+    return ''.join(chars)
 
 def parse_prefix(prefix):
     """ Parser the prefix from an IRC message.
@@ -50,15 +171,11 @@ def parse_prefix(prefix):
         - user is the username
         - host is the hostname or the servername
     """
-    nick = ''
-    user = ''
-    host = ''
-    if prefix.find('!') != -1:
-        nick, prefix = prefix.split('!', 1)
-    if prefix.find('@') != -1:
-        user, host = prefix.split('@', 1)
-    if not nick:
-        host = prefix
-
-    return Prefix(nick=nick, user=user, host=host)
-
+    nick, bang, rest = prefix.partition('!')
+    if bang:
+        user, _, host = rest.partition('@')
+        return Prefix(nick, user, host)
+    nick, at, host = prefix.partition('@')
+    if at:
+        return Prefix(nick, '', host)
+    return Prefix('', '', prefix)
@@ -0,0 +1,205 @@
+""" Keyword and regular expression triggers for messages.
+"""
+
+from collections import deque
+import re
+import threading
+
+# patterns which can't be a part of a combined expression:
+# backreferences change their meaning and inline flags apply to all
+UNCOMBINABLE = re.compile(r'\\[1-9]|\(\?P=|\(\?[iLmsux]+\)')
+
+class KeywordAutomaton:
+    """ Aho-Corasick automaton which finds every occurrence of a set of
+        keywords in one pass over the text.
+    """
+    def __init__(self, keywords):
+        self.goto = [{}] # state : {character : state}
+        self.fail = [0]
+        self.output = [()] # state : tuple(keyword) ending there
+        for keyword in keywords:
+            self.__add(keyword)
+        self.__link()
+
+    def __add(self, keyword):
+        """ Adds keyword to the trie.
+            For internal use.
+        """
+        state = 0
+        for char in keyword:
+            following = self.goto[state].get(char)
+            if following is None:
+                following = len(self.goto)
+                self.goto[state][char] = following
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(())
+            state = following
+        self.output[state] += (keyword,)
+
+    def __link(self):
+        """ Computes the failure links breadth first.
+            For internal use.
+        """
+        queue = deque(self.goto[0].itervalues())
+        while queue:
+            state = queue.popleft()
+            for char, following in self.goto[state].iteritems():
+                queue.append(following)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                link = self.goto[fallback].get(char, 0)
+                if link == following:
+                    link = 0
+                self.fail[following] = link
+                self.output[following] += self.output[link]
+
+    def search(self, text):
+        """ Returns the set of keywords found in text.
+        """
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
+
+class PatternMatcher:
+    """ Functions registered for keywords or regular expressions.
+        Keywords are matched case-insensitively anywhere in the text
+        with a single automaton. Regular expressions are combined into
+        one expression that is tried first; the separate expressions are
+        only searched when it matches. The matchers are rebuilt on the
+        next match after the registrations have changed, and only the
+        kind of matcher that changed is rebuilt.
+        The matcher can be changed from several threads.
+    """
+    def __init__(self):
+        self.keywords = {} # keyword : set(function)
+        self.regexps = {} # pattern : (compiled regexp, set(function))
+        self.automaton = None
+        self.keyword_functions = {} # keyword : tuple(function)
+        self.combined = None # compiled expression, or None for no filter
+        self.separate = () # (compiled regexp, functions) always searched
+        self.filtered = () # (compiled regexp, functions) after combined
+        self.keywords_changed = False
+        self.regexps_changed = False
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keywords) + len(self.regexps)
+
+    def add_keyword(self, keyword, function):
+        with self.lock:
+            self.keywords.setdefault(keyword.lower(), set()).add(function)
+            self.keywords_changed = True
+
+    def add_regexp(self, pattern, function):
+        """ Raises re.error if pattern is not a valid regexp.
+        """
+        with self.lock:
+            if pattern not in self.regexps:
+                self.regexps[pattern] = (re.compile(pattern), set())
+            self.regexps[pattern][1].add(function)
+            self.regexps_changed = True
+
+    def remove_keyword(self, keyword, function):
+        with self.lock:
+            functions = self.keywords.get(keyword.lower(), set())
+            functions.discard(function)
+            if not functions:
+                self.keywords.pop(keyword.lower(), None)
+            self.keywords_changed = True
+
+    def remove_regexp(self, pattern, function):
+        with self.lock:
+            compiled, functions = self.regexps.get(pattern, (None, set()))
+            functions.discard(function)
+            if not functions:
+                self.regexps.pop(pattern, None)
+            self.regexps_changed = True
+
+    def remove_module(self, module):
+        """ Removes every function defined in module.
+        """
+        with self.lock:
+            for keyword, functions in self.keywords.items():
+                for function in list(functions):
+                    if function.__module__ == module:
+                        functions.discard(function)
+                        self.keywords_changed = True
+                if not functions:
+                    del self.keywords[keyword]
+            for pattern, (compiled, functions) in self.regexps.items():
+                for function in list(functions):
+                    if function.__module__ == module:
+                        functions.discard(function)
+                        self.regexps_changed = True
+                if not functions:
+                    del self.regexps[pattern]
+
+    def __rebuild(self):
+        """ Rebuilds the matchers whose patterns have changed.
+            Must be called with the lock held.
+            For internal use.
+        """
+        if self.keywords_changed:
+            self.keywords_changed = False
+            self.automaton = KeywordAutomaton(self.keywords) \
+                             if self.keywords else None
+            self.keyword_functions = dict(
+                (keyword, tuple(functions))
+                for keyword, functions in self.keywords.iteritems())
+        if self.regexps_changed:
+            self.regexps_changed = False
+            separate = []
+            filtered = []
+            for pattern, (compiled, functions) in self.regexps.iteritems():
+                entry = (compiled, tuple(functions))
+                if UNCOMBINABLE.search(pattern):
+                    separate.append(entry)
+                else:
+                    filtered.append(entry)
+            self.combined = None
+            if filtered:
+                union = '|'.join('(?:%s)' % compiled.pattern
+                                 for compiled, _ in filtered)
+                try:
+                    self.combined = re.compile(union)
+                except (re.error, AssertionError): # e.g. too many groups
+                    separate.extend(filtered)
+                    filtered = []
+            self.separate = tuple(separate)
+            self.filtered = tuple(filtered)
+
+    def match(self, text):
+        """ Returns a list of (function, match) for the functions whose
+            patterns are found in text. match is the keyword for keyword
+            patterns and the match object for regular expressions.
+        """
+        if self.keywords_changed or self.regexps_changed:
+            with self.lock:
+                self.__rebuild()
+        matches = []
+        automaton = self.automaton
+        if automaton is not None:
+            keywords = self.keyword_functions
+            for keyword in automaton.search(text.lower()):
+                for function in keywords.get(keyword, ()):
+                    matches.append((function, keyword))
+        regexps = self.separate
+        if self.combined is not None and self.combined.search(text):
+            regexps += self.filtered
+        for compiled, functions in regexps:
+            found = compiled.search(text)
+            if found is not None:
+                for function in functions:
+                    matches.append((function, found))
+        return matches
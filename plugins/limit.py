@@ -1,76 +1,116 @@
-from parser import parse_prefix
+import ircutils
+
+import logging
+import os
+import re
+import sqlite3
+
+logger = logging.getLogger('mib.plugins.limit')
+
+def legacy_mask(regexp):
+    """ Turns a regexp from an old limit.cfg back into the IRC mask it
+        was made from. Old versions only turned * into .* and ? into .?,
+        so everything else in it is the mask itself.
+    """
+    return regexp.replace('.*', '*').replace('.?', '?')
 
 class Limit_Plugin:
     """ Plugin to control which users can use which commands.
-        Saves list of commands and their permissions to limit.cfg
-        in format "command regexp".
+        Saves commands and their permissions to an SQLite database,
+        limit.db by default, as soon as they change.
+        Permissions from an old limit.cfg file in format
+        "command regexp" are imported as masks on the first start.
     """
 
     def __init__(self, mib, params=None):
         self.mib = mib
+        # changes the core's state, so it runs in the event loop
+        self.mib.executor.configure(__name__, inline=True)
         self.mib.register_privmsg_cmd('allow', self.allow)
         self.mib.register_privmsg_cmd('deny', self.deny)
+        filename = params[0] if params else 'limit.db'
+        self.db = sqlite3.connect(filename)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS permissions '
+                        '(command TEXT, regexp TEXT, '
+                        'PRIMARY KEY (command, regexp))')
+        self.db.commit()
+        self.import_cfg()
         self.load_lists()
 
     def clean(self):
-        self.save_lists()
+        self.db.close()
 
     def allow(self, msg):
         parsed = self.parse(msg)
         if parsed:
             cmd, mask = parsed
-            print 'Adding %s for command %s' % (mask, cmd)
+            logger.info('Adding %s for command %s', mask, cmd)
             self.mib.add_cmd_permission(cmd, mask)
+            with self.db:
+                self.db.execute('INSERT OR IGNORE INTO permissions '
+                                'VALUES (?, ?)',
+                                (cmd, ircutils.regexpify(mask)))
 
     def deny(self, msg):
         parsed = self.parse(msg)
         if parsed:
             cmd, mask = parsed
-            print 'Removing %s from command %s' % (mask, cmd)
+            logger.info('Removing %s from command %s', mask, cmd)
             self.mib.rm_cmd_permission(cmd, mask)
+            with self.db:
+                self.db.execute('DELETE FROM permissions '
+                                'WHERE command = ? AND regexp = ?',
+                                (cmd, ircutils.regexpify(mask)))
 
     def parse(self, msg):
-        prefix = parse_prefix(msg.prefix)
+        prefix = msg.source
         postfix = msg.postfix.split()
         if len(postfix) != 2:
             error_msg = 'Usage: mask command'
-            self.mib.socket.send('PRIVMSG %s :%s' % (prefix.nick, error_msg))
+            self.mib.say(prefix.nick, error_msg)
             return None
         mask = postfix[0]
         cmd = postfix[1]
         return (cmd, mask)
 
-    def load_lists(self):
+    def import_cfg(self):
+        """ Moves the permissions from an old limit.cfg to the database
+            and renames the file to limit.cfg.imported. The regexps are
+            stored as the masks they were made from, so that deny can
+            remove them.
+        """
         try:
             f = open('limit.cfg')
         except IOError:
             return
 
         try:
+            rows = []
             for line in f:
                 line = line.split()
                 if len(line) != 2:
                     continue # config file syntax error
-                cmd = line[0]
-                mask = line[1]
-                self.mib.add_cmd_permission(cmd, mask, regexpify=False)
+                mask = legacy_mask(line[1])
+                rows.append((line[0], ircutils.regexpify(mask)))
         finally:
             f.close()
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO permissions '
+                                'VALUES (?, ?)', rows)
+        os.rename('limit.cfg', 'limit.cfg.imported')
+        logger.info('Imported %d permissions from limit.cfg', len(rows))
 
-    def save_lists(self):
-        try:
-            f = open('limit.cfg', 'w')
-        except IOError:
-            return
-
-        try:
-            for cmd in self.mib.command_masks:
-                for regexp in self.mib.command_masks[cmd]:
-                    line = '%s %s\n' % (cmd, regexp.pattern)
-                    f.write(line)
-        finally:
-            f.close()
+    def load_lists(self):
+        for cmd, regexp in self.db.execute('SELECT command, regexp '
+                                           'FROM permissions'):
+            try:
+                self.mib.add_cmd_permission(cmd, regexp, regexpify=False)
+            except re.error:
+                logger.warning('Invalid regexp %s for command %s',
+                               regexp, cmd)
 
 def init(mib, params=None):
     return Limit_Plugin(mib, params)
-
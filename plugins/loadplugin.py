@@ -1,31 +1,39 @@
-from parser import parse_prefix
-
 class Load_Plugin:
-    """ Plugin to load plugins with a command from IRC.
+    """ Plugin to load, unload and reload plugins with a command from IRC.
+        Usage: plugin [load|unload|reload] name [params]
     """
 
     def __init__(self, mib, params=None):
         self.mib = mib
+        # changes the core's state, so it runs in the event loop
+        self.mib.executor.configure(__name__, inline=True)
         self.mib.register_privmsg_cmd('plugin', self.load_plugin)
 
     def clean(self):
         pass
 
     def load_plugin(self, msg):
-        prefix = parse_prefix(msg.prefix)
+        prefix = msg.source
         plugin = msg.postfix.split()
+        action = 'load'
+        if plugin and plugin[0] in ('load', 'unload', 'reload'):
+            action = plugin.pop(0)
         if len(plugin) < 1:
             error_msg = 'Not enough parameters'
-            self.mib.socket.send('PRIVMSG %s :%s' % (prefix.nick, error_msg))
+            self.mib.say(prefix.nick, error_msg)
             return
         if len(plugin) >= 2:
             params = plugin[1:]
         else:
             params = None
         plugin = plugin[0]
-        succ, msg = self.mib.load_plugin(plugin, params)
-        self.mib.socket.send('PRIVMSG %s :%s' % (prefix.nick, msg))
+        if action == 'unload':
+            succ, msg = self.mib.unload_plugin(plugin)
+        elif action == 'reload':
+            succ, msg = self.mib.reload_plugin(plugin)
+        else:
+            succ, msg = self.mib.load_plugin(plugin, params)
+        self.mib.say(prefix.nick, msg)
 
 def init(mib, params=None):
     return Load_Plugin(mib, params)
-
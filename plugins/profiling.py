@@ -0,0 +1,44 @@
+import profiler
+
+class Profiling:
+    """ Plugin to profile the bot while it runs.
+        Usage: profile [sample|trace] [seconds]
+        sample takes stacks of every thread and saves them for flame
+        graphs, trace records every call in the event loop for pstats.
+        Tells the file name when the profile has been saved.
+    """
+    def __init__(self, mib, params=None):
+        self.mib = mib
+        self.default_seconds = 10
+        self.max_seconds = 300
+        self.mib.register_privmsg_cmd('profile', self.profile)
+
+    def clean(self):
+        pass
+
+    def profile(self, msg):
+        nick = msg.source.nick
+        network = msg.network
+        args = msg.postfix.split()
+        mode = profiler.SAMPLE
+        if args and args[0] in (profiler.SAMPLE, profiler.TRACE):
+            mode = args.pop(0)
+        try:
+            seconds = float(args[0]) if args else self.default_seconds
+        except ValueError:
+            self.mib.say(nick, 'Usage: profile [sample|trace] [seconds]')
+            return
+        seconds = min(max(seconds, 0.1), self.max_seconds)
+        def done(filename):
+            if filename:
+                text = 'Profile saved to %s' % filename
+            else:
+                text = 'Unable to save the profile'
+            self.mib.say(nick, text, network)
+        if self.mib.profiler.start(seconds, mode, done) is None:
+            self.mib.say(nick, 'Already profiling')
+            return
+        self.mib.say(nick, 'Profiling in %s mode for %g s' % (mode, seconds))
+
+def init(mib, params=None):
+    return Profiling(mib, params)
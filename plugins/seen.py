@@ -0,0 +1,103 @@
+from state import irc_lower
+
+import time
+
+class Seen:
+    """ Plugin to look up the channel log.
+        Needs LOGSTORE_FILE to be set in config.
+        Usage: seen <nick>
+               grep <words> (on a channel searches only that channel)
+        Only the lines of channels the asking user is on are shown,
+        so secret channels can't be read through the bot.
+    """
+    def __init__(self, mib, params=None):
+        self.mib = mib
+        if mib.logstore is None:
+            raise ValueError('LOGSTORE_FILE is not set')
+        self.results = 3 # lines given by grep
+        self.mib.register_privmsg_cmd('seen', self.seen)
+        self.mib.register_privmsg_cmd('grep', self.grep)
+
+    def clean(self):
+        pass
+
+    def reply(self, msg, text):
+        target = msg.middle[0]
+        if target[:1] not in self.mib.socket.isupport.chantypes():
+            target = msg.source.nick
+        self.mib.say(target, text)
+
+    def ago(self, when):
+        seconds = int(max(time.time() - when, 0))
+        if seconds < 60:
+            return '%d s' % seconds
+        if seconds < 3600:
+            return '%d min' % (seconds / 60)
+        if seconds < 86400:
+            return '%d h %d min' % (seconds / 3600, seconds % 3600 / 60)
+        return '%d d %d h' % (seconds / 86400, seconds % 86400 / 3600)
+
+    def is_command(self, text):
+        words = text.split(None, 1)
+        return bool(words) and words[0] in self.mib.cmd_prefixes
+
+    def visible(self, msg):
+        """ Returns the lowercased names of the channels whose lines
+            the sender of msg may see.
+        """
+        return set(irc_lower(channel) for channel in
+                   self.mib.state.channels_of(msg.source.nick))
+
+    def search(self, msg, channels, limit, **query):
+        """ Returns at most limit lines of channels matching query,
+            newest first.
+        """
+        lines = []
+        for channel in channels:
+            lines.extend(self.mib.logstore.search(network=msg.network,
+                                                  channel=channel,
+                                                  limit=limit, **query))
+        lines.sort(key=lambda line: line.time, reverse=True)
+        return lines[:limit]
+
+    def seen(self, msg):
+        nick = msg.postfix.strip()
+        if not nick:
+            self.reply(msg, 'Usage: seen <nick>')
+            return
+        channels = self.visible(msg)
+        line = self.mib.logstore.seen(msg.network, nick)
+        if line is not None and irc_lower(line.channel) not in channels:
+            # said last on another channel, look for the last visible line
+            lines = self.search(msg, channels, 1, nick=nick)
+            line = lines[0] if lines else None
+        if line is None:
+            self.reply(msg, 'I have not seen %s' % nick)
+            return
+        self.reply(msg, '%s was last seen %s ago on %s: %s' % (
+            line.nick, self.ago(line.time), line.channel, line.text))
+
+    def grep(self, msg):
+        text = msg.postfix.strip()
+        if not text:
+            self.reply(msg, 'Usage: grep <words>')
+            return
+        channel = msg.middle[0]
+        if channel[:1] in self.mib.socket.isupport.chantypes():
+            channels = [channel]
+        else:
+            channels = self.visible(msg)
+        lines = self.search(msg, channels, self.results * 4, text=text)
+        # leave out the grep commands, including this one
+        lines = [line for line in lines
+                 if not self.is_command(line.text)][:self.results]
+        if not lines:
+            self.reply(msg, 'No matches')
+        for line in lines:
+            self.reply(msg, '[%s] %s <%s> %s' % (
+                time.strftime('%Y-%m-%d %H:%M',
+                              time.localtime(line.time)),
+                line.channel, line.nick, line.text))
+
+def init(mib, params=None):
+    return Seen(mib, params)
@@ -0,0 +1,54 @@
+import ircsocket
+import metrics
+
+import time
+
+class Stats:
+    """ Plugin to show runtime statistics.
+        Usage: stats [callbacks]
+    """
+    def __init__(self, mib, params=None):
+        self.mib = mib
+        self.mib.register_privmsg_cmd('stats', self.stats)
+
+    def clean(self):
+        pass
+
+    def reply(self, msg, text):
+        self.mib.say(msg.source.nick, text)
+
+    def stats(self, msg):
+        if msg.postfix.strip() == 'callbacks':
+            self.callbacks(msg)
+            return
+        # since the bot started, not since this plugin was loaded
+        uptime = max(time.time() - ircsocket.STARTED, 1)
+        received = metrics.counter('mib_lines_received_total', '').get()
+        sent = metrics.counter('mib_lines_sent_total', '').get()
+        count, total = metrics.histogram('mib_sendqueue_wait_seconds',
+                                         '').get()
+        self.reply(msg, 'in: %d lines (%.2f/s), out: %d lines (%.2f/s), '
+                   'parse failures: %d' % (
+                       received, received / uptime, sent, sent / uptime,
+                       metrics.counter('mib_parse_failures_total', '').get()))
+        self.reply(msg, 'send queue: %d lines, %d dropped, '
+                   'average wait %.3f s' % (
+                       metrics.gauge('mib_sendqueue_depth', '').get(),
+                       metrics.counter('mib_sendqueue_dropped_total',
+                                       '').get(),
+                       total / count if count else 0))
+
+    def callbacks(self, msg):
+        duration = metrics.histogram('mib_callback_duration_seconds', '')
+        errors = metrics.counter('mib_callback_errors_total', '')
+        depth = metrics.gauge('mib_plugin_queue_depth', '')
+        for labels in sorted(duration.values.keys()):
+            count, total = duration.get(labels)
+            self.reply(msg, '%s.%s: %d calls, average %.3f s, %d errors, '
+                       'queue %d' % (labels[0], labels[1], count,
+                                     total / count if count else 0,
+                                     errors.get(labels),
+                                     depth.get(labels[:1])))
+
+def init(mib, params=None):
+    return Stats(mib, params)
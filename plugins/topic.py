@@ -1,5 +1,3 @@
-from parser import parse_prefix
-
 class Topic:
     """ Example plugin to change channels topic.
     """
@@ -18,7 +16,7 @@ class Topic:
     def change_topic(self, msg):
         """ Changes topic according to what is given in msg
             Parameters:
-                msg: IRCMsg named tuple
+                msg: IRCMsg
         """
         # channel on which to change to topic
         channel = msg.params
@@ -26,11 +24,10 @@ class Topic:
         if channel[0] != '#':
             # private message, check for channel in the message
             # change sender to the private message sender instead of channel
-            sender = parse_prefix(msg.prefix).nick
+            sender = msg.source.nick
             if msg.postfix[0] != '#':
                 # no channel in the message, reply with error
-                self.mib.socket.send('PRIVMSG %s :%s' %(sender, 
-                                                        'No channel given'))
+                self.mib.say(sender, 'No channel given')
                 return
             else:
                 # the channel was given as the first parameter
@@ -45,8 +42,16 @@ class Topic:
 
         if not topic:
             # topic is empty, reply with error
-            self.mib.socket.send('PRIVMSG %s :%s' %(sender,
-                                                    'No topic given'))
+            self.mib.say(sender, 'No topic given')
+            return
+
+        state = self.mib.state
+        if not state.is_on(channel):
+            self.mib.say(sender, 'Not on ' + channel)
+            return
+        if 't' in state.modes(channel) and not state.is_op(channel):
+            # only operators can change the topic
+            self.mib.say(sender, 'Not an operator')
             return
 
         # else, we can set a new topic
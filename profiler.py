@@ -0,0 +1,140 @@
+""" Profiling of a running bot.
+"""
+
+import cProfile
+import logging
+import os
+import sys
+import thread
+import threading
+import time
+
+logger = logging.getLogger('mib.profiler')
+
+# modes of Profiler.start
+TRACE = 'trace'
+SAMPLE = 'sample'
+
+def collapse(frame, root):
+    """ Returns the stack of frame as a line of the collapsed stack
+        format of flame graph tools: the functions from root to frame
+        separated by semicolons.
+    """
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('%s (%s:%d)' % (code.co_name,
+                                     os.path.basename(code.co_filename),
+                                     code.co_firstlineno))
+        frame = frame.f_back
+    stack.append(root)
+    return ';'.join(reversed(stack))
+
+class Profiler:
+    """ Profiles the bot for a while without restarting it.
+        In TRACE mode every call made in the event loop's thread is
+        recorded with cProfile: parsing, dispatching, sending and the
+        callbacks run inline. The result is saved with pstats.
+        In SAMPLE mode a thread takes the stacks of every other thread,
+        the plugin callbacks included, every interval seconds. The
+        result is saved in the collapsed stack format which
+        flamegraph.pl and speedscope read.
+        Only one profile is made at a time.
+    """
+    def __init__(self, loop, directory='.', interval=0.005):
+        self.loop = loop
+        self.directory = directory
+        self.interval = interval
+        self.profile = None # cProfile.Profile in TRACE mode
+        self.sampler = None # sampling thread in SAMPLE mode
+        self.running = False
+        self.lock = threading.Lock()
+
+    def start(self, seconds, mode=SAMPLE, done=None):
+        """ Starts profiling for seconds. done is called with the name
+            of the file the profile was saved to, or None if saving it
+            failed. Returns the file name, or None if a profile is
+            already being made.
+            Raises ValueError if mode is unknown.
+        """
+        if mode not in (TRACE, SAMPLE):
+            raise ValueError('Unknown profiling mode %s' % mode)
+        with self.lock:
+            if self.running:
+                return None
+            self.running = True
+        extension = 'pstats' if mode == TRACE else 'collapsed'
+        filename = os.path.join(self.directory, 'mib-%s.%s' % (
+            time.strftime('%Y%m%d-%H%M%S'), extension))
+        logger.info('Profiling in %s mode for %g s to %s',
+                    mode, seconds, filename)
+        if mode == TRACE:
+            self.loop.call_soon_threadsafe(self.__trace, seconds, filename,
+                                           done)
+        else:
+            self.sampler = threading.Thread(target=self.__sample,
+                                            args=(seconds, filename, done),
+                                            name='profiler')
+            self.sampler.daemon = True
+            self.sampler.start()
+        return filename
+
+    def __trace(self, seconds, filename, done):
+        """ Starts cProfile in the event loop's thread.
+            For internal use.
+        """
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        self.loop.call_later(seconds, self.__stop_trace, filename, done)
+
+    def __stop_trace(self, filename, done):
+        """ For internal use.
+        """
+        self.profile.disable()
+        try:
+            self.profile.dump_stats(filename)
+        except (IOError, OSError), e:
+            logger.error('Unable to save profile to %s: %s', filename, e)
+            filename = None
+        self.profile = None
+        self.__finish(filename, done)
+
+    def __sample(self, seconds, filename, done):
+        """ Main function of the sampling thread.
+            For internal use.
+        """
+        own = thread.get_ident()
+        counts = {} # collapsed stack : samples
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            names = dict((other.ident, other.name)
+                         for other in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = collapse(frame, names.get(ident, str(ident)))
+                counts[stack] = counts.get(stack, 0) + 1
+            del frame # don't keep the last thread's frames alive
+            time.sleep(self.interval)
+        try:
+            f = open(filename, 'w')
+            try:
+                for stack, count in sorted(counts.iteritems()):
+                    f.write('%s %d\n' % (stack, count))
+            finally:
+                f.close()
+        except (IOError, OSError), e:
+            logger.error('Unable to save profile to %s: %s', filename, e)
+            filename = None
+        self.sampler = None
+        self.__finish(filename, done)
+
+    def __finish(self, filename, done):
+        """ For internal use.
+        """
+        with self.lock:
+            self.running = False
+        if filename:
+            logger.info('Saved profile to %s', filename)
+        if done:
+            done(filename)
@@ -0,0 +1,71 @@
+""" Rate limiting of privmsg commands.
+"""
+
+from collections import OrderedDict
+
+from state import irc_lower
+from tokenbucket import TokenBucket
+
+class BucketTable:
+    """ Token buckets by key. At most max_size buckets are kept;
+        the least recently used one is forgotten to make room.
+    """
+    def __init__(self, rate, burst, max_size=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_size = max_size
+        self.buckets = OrderedDict() # key : TokenBucket
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def get(self, key):
+        """ Returns the bucket for key, creating it if needed.
+        """
+        bucket = self.buckets.pop(key, None)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            if len(self.buckets) >= self.max_size:
+                self.buckets.popitem(last=False)
+        self.buckets[key] = bucket
+        return bucket
+
+class RateLimiter:
+    """ Limits how often commands can be used by one user (by the
+        user@host part of the prefix) and on one channel.
+        user and channel are (commands per second, burst) tuples,
+        or None for no limit. costs is a dict of command : tokens,
+        commands not in it cost one token. A cost larger than a burst
+        takes the whole burst, so the command can still be used.
+        chantypes is called with a network and returns its channel
+        prefixes; without it the RFC 1459 prefixes # and & are used.
+    """
+    def __init__(self, user=None, channel=None, costs=None, max_size=10000,
+                 chantypes=None):
+        self.users = BucketTable(user[0], user[1], max_size) if user \
+                     else None
+        self.channels = BucketTable(channel[0], channel[1], max_size) \
+                        if channel else None
+        self.costs = costs or {}
+        self.chantypes = chantypes or (lambda network: '#&')
+
+    def allow(self, cmd, msg):
+        """ Returns True and takes the command's cost from the buckets
+            if the sender of msg, and its channel, can use cmd now.
+        """
+        cost = self.costs.get(cmd, 1)
+        buckets = []
+        if self.users is not None:
+            source = msg.source
+            buckets.append(self.users.get(source.user + '@' + source.host))
+        target = msg.middle[0] if msg.middle else ''
+        if self.channels is not None and \
+           target[:1] in self.chantypes(msg.network):
+            buckets.append(self.channels.get((msg.network,
+                                              irc_lower(target))))
+        for bucket in buckets:
+            if bucket.delay(min(cost, bucket.burst)) > 0:
+                return False
+        for bucket in buckets:
+            bucket.consume(min(cost, bucket.burst))
+        return True
@@ -0,0 +1,127 @@
+""" Caching of the replies of privmsg commands.
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+import metrics
+
+LOOKUPS = metrics.counter('mib_response_cache_total',
+                          'Cached command lookups by result',
+                          ('command', 'result'))
+
+class ResponseCache:
+    """ Replies of commands by key, each kept for its own time to live.
+        At most size replies are kept; the least recently used one is
+        forgotten to make room. Keys are tuples starting with the name
+        of the plugin the reply came from.
+        The cache can be used from several threads.
+    """
+    def __init__(self, size=1024):
+        self.size = size
+        self.entries = OrderedDict() # key : (expires, reply)
+        self.waiting = {} # key being computed : list(waiter)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, key, waiter):
+        """ Returns ('hit', reply) if key has a fresh reply.
+            Otherwise returns ('coalesced', None) and adds waiter to the
+            waiters of key if its reply is being computed, or
+            ('miss', None) if the caller must compute it and give it
+            to finish().
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[0] > time.time():
+                self.entries[key] = entry
+                return 'hit', entry[1]
+            if key in self.waiting:
+                self.waiting[key].append(waiter)
+                return 'coalesced', None
+            self.waiting[key] = []
+            return 'miss', None
+
+    def finish(self, key, reply, ttl):
+        """ Stores the reply computed for key, or only forgets that it
+            was being computed if reply is None.
+            Returns the waiters which are waiting for the reply.
+        """
+        with self.lock:
+            if reply is not None:
+                if len(self.entries) >= self.size:
+                    self.entries.popitem(last=False)
+                self.entries[key] = (time.time() + ttl, reply)
+            return self.waiting.pop(key, [])
+
+    def remove_module(self, module):
+        """ Forgets the replies of the plugin module.
+        """
+        with self.lock:
+            for key in self.entries.keys():
+                if key[0] == module:
+                    del self.entries[key]
+
+class CachedCommand:
+    """ A privmsg command handler whose replies are cached for ttl
+        seconds. The handler returns its reply, a string or a list of
+        lines, instead of sending it; say(target, reply, network) sends
+        it where the message came from. Replies are cached by the
+        command and its arguments, and by the channel as well if
+        per_channel is True. The same command coming in while the
+        reply is being computed is answered with that reply.
+        Compares equal to the handler, so it can be unregistered
+        with it.
+    """
+    def __init__(self, cmd, function, ttl, per_channel, cache, say,
+                 chantypes):
+        self.cmd = cmd
+        self.function = function
+        self.ttl = ttl
+        self.per_channel = per_channel
+        self.cache = cache
+        self.say = say
+        self.chantypes = chantypes # returns the chantypes of a network
+        # run like the plugin's other callbacks
+        self.__module__ = function.__module__
+        self.__name__ = getattr(function, '__name__', cmd)
+
+    def __eq__(self, other):
+        if isinstance(other, CachedCommand):
+            other = other.function
+        return self.function == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.function)
+
+    def __call__(self, msg):
+        target = msg.middle[0] if msg.middle else ''
+        channel = target[:1] in self.chantypes(msg.network)
+        if not channel:
+            target = msg.source.nick
+        key = (self.__module__, self.cmd, ' '.join(msg.postfix.split()))
+        if self.per_channel:
+            key += (msg.network, target if channel else None)
+        waiter = (msg.network, target)
+        result, reply = self.cache.lookup(key, waiter)
+        LOOKUPS.inc((self.cmd, result))
+        if result == 'coalesced':
+            return
+        if result == 'hit':
+            self.say(target, reply, msg.network)
+            return
+        reply = None
+        try:
+            reply = self.function(msg)
+        finally:
+            waiters = self.cache.finish(key, reply, self.ttl)
+        if reply is None:
+            return
+        for network, other in [waiter] + waiters:
+            self.say(other, reply, network)
@@ -0,0 +1,214 @@
+""" Outbound message scheduler.
+"""
+
+from collections import deque
+import time
+
+import metrics
+
+WAIT_TIME = metrics.histogram('mib_sendqueue_wait_seconds',
+                              'Time lines spend in the send queue')
+DROPPED = metrics.counter('mib_sendqueue_dropped_total',
+                          'Lines dropped because the send queue was full')
+
+# Protocol messages that are sent before any queued chat.
+PRIORITY_COMMANDS = frozenset(['PONG', 'PING', 'PASS', 'CAP', 'NICK', 'USER',
+                               'JOIN', 'PART', 'QUIT'])
+
+def split_line(line):
+    """ Returns the command and the first parameter (the target) of
+        an IRC protocol line. Either one can be empty.
+    """
+    parts = line.split(' ', 2)
+    command = parts[0].upper()
+    if len(parts) > 1:
+        return command, parts[1]
+    return command, ''
+
+class SendQueue:
+    """ Queue of lines waiting to be sent to the server.
+        Lines with one of PRIORITY_COMMANDS are sent first, in order.
+        Other lines are queued per target and the targets take turns,
+        so one busy channel doesn't starve the others. Lines added
+        together with extend() are a unit: once its first line is sent,
+        its target keeps the turn until the whole unit has been sent.
+        At most max_size non-priority lines are kept. When the queue is
+        full, a line identical to one already queued for the same target
+        is dropped, otherwise the oldest line or unit of the longest
+        target queue is dropped to make room.
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.priority = deque() # (time queued, line)
+        # target : deque((time queued, line, continues the previous line))
+        self.targets = {}
+        self.order = deque() # targets with queued lines, in turn order
+        self.size = 0 # number of non-priority lines
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.priority) + self.size
+
+    def append(self, line):
+        """ Adds line to the queue.
+        """
+        command, target = split_line(line)
+        if command in PRIORITY_COMMANDS:
+            self.priority.append((time.time(), line))
+            return
+        if self.size >= self.max_size and \
+           not self.__make_room([line], target):
+            return
+        queue = self.targets.get(target)
+        if queue is None:
+            queue = self.targets[target] = deque()
+            self.order.append(target)
+        queue.append((time.time(), line, False))
+        self.size += 1
+
+    def extend(self, lines):
+        """ Adds lines to the queue as a unit. The lines must have the
+            same command and target, e.g. the pieces of a long message.
+        """
+        if not lines:
+            return
+        command, target = split_line(lines[0])
+        now = time.time()
+        if command in PRIORITY_COMMANDS:
+            self.priority.extend((now, line) for line in lines)
+            return
+        if self.size + len(lines) > self.max_size and \
+           not self.__make_room(lines, target):
+            return
+        queue = self.targets.get(target)
+        if queue is None:
+            queue = self.targets[target] = deque()
+            self.order.append(target)
+        queue.append((now, lines[0], False))
+        queue.extend((now, line, True) for line in lines[1:])
+        self.size += len(lines)
+
+    def __make_room(self, lines, target):
+        """ Applies the overflow policy to a full queue.
+            Returns False if lines should be dropped instead.
+            For internal use.
+        """
+        queue = self.targets.get(target)
+        if len(lines) > self.max_size or (queue is not None and any(
+                queued == lines[0] for _, queued, _ in queue)):
+            self.__drop(len(lines))
+            return False
+        while self.size + len(lines) > self.max_size:
+            longest = max(self.targets, key=lambda t: len(self.targets[t]))
+            queue = self.targets[longest]
+            dropped = 0
+            while dropped == 0 or (queue and queue[0][2]):
+                queue.popleft() # the rest of a unit goes with it
+                dropped += 1
+            self.size -= dropped
+            self.__drop(dropped)
+            if not queue:
+                del self.targets[longest]
+                self.order.remove(longest)
+        return True
+
+    def __drop(self, count):
+        """ For internal use.
+        """
+        self.dropped += count
+        DROPPED.inc(amount=count)
+
+    def clear(self):
+        """ Removes every queued line, e.g. after a disconnect.
+        """
+        self.priority.clear()
+        self.targets.clear()
+        self.order.clear()
+        self.size = 0
+
+    def has_priority(self):
+        """ Returns True if the next line is a priority line.
+        """
+        return bool(self.priority)
+
+    def pop(self):
+        """ Removes and returns the next line to send.
+            Raises IndexError if the queue is empty.
+        """
+        if self.priority:
+            queued, line = self.priority.popleft()
+        else:
+            target = self.order.popleft()
+            queue = self.targets[target]
+            queued, line, _ = queue.popleft()
+            self.size -= 1
+            if not queue:
+                del self.targets[target]
+            elif queue[0][2]:
+                self.order.appendleft(target) # the rest of the unit
+            else:
+                self.order.append(target)
+        WAIT_TIME.observe(time.time() - queued)
+        return line
+
+    def push_front(self, line):
+        """ Puts line back to the queue so that it is the next line
+            sent to its target.
+        """
+        command, target = split_line(line)
+        if command in PRIORITY_COMMANDS:
+            self.priority.appendleft((time.time(), line))
+            return
+        queue = self.targets.get(target)
+        if queue is None:
+            queue = self.targets[target] = deque()
+            self.order.appendleft(target)
+        queue.appendleft((time.time(), line, False))
+        self.size += 1
+
+    def take_priority(self, accept):
+        """ Removes the priority lines at the front of the queue for
+            which accept(line) returns True, up to the first one it
+            returns False for, and returns them in order.
+        """
+        taken = []
+        now = time.time()
+        while self.priority and accept(self.priority[0][1]):
+            queued, line = self.priority.popleft()
+            WAIT_TIME.observe(now - queued)
+            taken.append(line)
+        return taken
+
+    def peek_target(self, target):
+        """ Returns the next line queued for target, or None.
+        """
+        queue = self.targets.get(target)
+        return queue[0][1] if queue else None
+
+    def pop_target(self, target):
+        """ Removes and returns the next line queued for target.
+            Raises KeyError if there are no lines for target.
+        """
+        queue = self.targets[target]
+        queued, line, _ = queue.popleft()
+        self.size -= 1
+        if not queue:
+            del self.targets[target]
+            self.order.remove(target)
+        elif queue[0][2]:
+            self.order.remove(target)
+            self.order.appendleft(target) # the rest of the unit
+        WAIT_TIME.observe(time.time() - queued)
+        return line
+
+    def starts_unit(self, target):
+        """ Returns True if the next line queued for target is the first
+            of a unit of several lines.
+        """
+        queue = self.targets.get(target)
+        return bool(queue) and len(queue) > 1 and queue[1][2]
+
+    def waiting_targets(self):
+        """ Returns the targets with queued lines, in turn order.
+        """
+        return list(self.order)
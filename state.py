@@ -0,0 +1,405 @@
+""" Tracking of the channels the bot is on and the users on them.
+"""
+
+import string
+
+RFC1459_LOWER = string.maketrans(string.ascii_uppercase + '[]\\~',
+                                 string.ascii_lowercase + '{}|^')
+
+# command : name of the State method which handles it
+UPDATERS = {'001': 'on_welcome',
+            'JOIN': 'on_join',
+            'PART': 'on_part',
+            'KICK': 'on_kick',
+            'QUIT': 'on_quit',
+            'NICK': 'on_nick',
+            'MODE': 'on_mode',
+            'TOPIC': 'on_topic',
+            '324': 'on_channelmodeis',
+            '332': 'on_topicreply',
+            '353': 'on_namreply',
+            '366': 'on_endofnames',
+            '396': 'on_hosthidden'}
+
+def irc_lower(name):
+    """ Lowercases name using the rfc1459 case mapping.
+    """
+    return intern(name.translate(RFC1459_LOWER))
+
+class Channel(object):
+    """ A channel the bot is on.
+    """
+    __slots__ = ('name', 'members', 'topic', 'modes')
+
+    def __init__(self, name):
+        self.name = name
+        self.members = {} # lowercased nick : prefix modes, e.g. 'ov'
+        self.topic = ''
+        self.modes = {} # mode : parameter, True or set(parameter)
+
+class User(object):
+    """ A user seen on at least one of the bot's channels.
+    """
+    __slots__ = ('nick', 'channels')
+
+    def __init__(self, nick):
+        self.nick = nick
+        self.channels = set() # lowercased channel names
+
+class State:
+    """ Keeps track of the bot's channels, their members, topics and
+        modes from the messages the server sends.
+        All names given to the query functions are case insensitive.
+        The state is updated in the event loop's thread, and the queries
+        may be called from other threads at the same time. They only
+        iterate over copies and tolerate entries vanishing in between,
+        so an answer may miss a change being made, but they never raise.
+    """
+    def __init__(self, nick=''):
+        self.nick = nick # the bot's own nick
+        self.userhost = None # the bot's own user@host, once seen
+        self.channels = {} # lowercased channel : Channel
+        self.users = {} # lowercased nick : User
+        self.names = {} # lowercased channel : members from NAMES replies
+        self.set_prefix('qaohv', '~&@%+')
+        self.set_chanmodes('beI', 'k', 'l')
+
+    def set_prefix(self, modes, chars):
+        """ Sets the channel modes that give a nick prefix, in order
+            of rank, and the corresponding prefix characters.
+        """
+        self.prefix_modes = modes
+        self.prefix_chars = dict(zip(chars, modes))
+
+    def set_chanmodes(self, lists, always, when_set):
+        """ Sets the channel modes which take a parameter:
+            modes which are lists, modes which always take a parameter
+            and modes which take a parameter only when set.
+        """
+        self.list_modes = lists
+        self.param_modes = always
+        self.set_param_modes = when_set
+
+    def update(self, msg):
+        """ Updates the state from msg.
+        """
+        name = UPDATERS.get(msg.cmd)
+        if name:
+            getattr(self, name)(msg)
+
+    def reset(self):
+        """ Forgets everything, e.g. after a disconnect.
+        """
+        self.channels.clear()
+        self.users.clear()
+        self.names.clear()
+        self.userhost = None
+
+    def restore(self, other):
+        """ Takes the nick, channels and users of other, a State
+            tracked by another process.
+        """
+        self.nick = other.nick
+        self.userhost = other.userhost
+        self.channels = other.channels
+        self.users = other.users
+        self.names = {}
+        self.prefix_modes = other.prefix_modes
+        self.prefix_chars = other.prefix_chars
+        self.list_modes = other.list_modes
+        self.param_modes = other.param_modes
+        self.set_param_modes = other.set_param_modes
+
+    # queries
+
+    def source(self):
+        """ Returns the bot's own nick!user@host as the server sends
+            it to others, or None if it hasn't been seen yet.
+        """
+        if self.userhost is None:
+            return None
+        return '%s!%s' % (self.nick, self.userhost)
+
+    def is_on(self, channel):
+        """ Returns True if the bot is on channel.
+        """
+        return irc_lower(channel) in self.channels
+
+    def channel_names(self):
+        """ Returns the names of the channels the bot is on.
+        """
+        return [channel.name for channel in self.channels.values()]
+
+    def members(self, channel):
+        """ Returns the nicks on channel.
+        """
+        channel = self.channels.get(irc_lower(channel))
+        if not channel:
+            return []
+        users = [self.users.get(nick) for nick in channel.members.keys()]
+        return [user.nick for user in users if user is not None]
+
+    def has_member(self, channel, nick):
+        """ Returns True if nick is on channel.
+        """
+        channel = self.channels.get(irc_lower(channel))
+        return bool(channel) and irc_lower(nick) in channel.members
+
+    def member_modes(self, channel, nick=None):
+        """ Returns the prefix modes (e.g. 'ov') nick has on channel,
+            or None if nick is not on channel.
+            nick defaults to the bot's own nick.
+        """
+        channel = self.channels.get(irc_lower(channel))
+        if not channel:
+            return None
+        return channel.members.get(irc_lower(nick or self.nick))
+
+    def is_op(self, channel, nick=None):
+        """ Returns True if nick has operator status or higher on channel.
+            nick defaults to the bot's own nick.
+        """
+        modes = self.member_modes(channel, nick)
+        return bool(modes) and modes[0] in self.prefix_modes[
+            :self.prefix_modes.find('o') + 1]
+
+    def has_voice(self, channel, nick=None):
+        """ Returns True if nick has voice or a higher status on channel.
+            nick defaults to the bot's own nick.
+        """
+        return bool(self.member_modes(channel, nick))
+
+    def channels_of(self, nick):
+        """ Returns the names of the bot's channels nick is on.
+        """
+        user = self.users.get(irc_lower(nick))
+        if not user:
+            return []
+        channels = [self.channels.get(channel)
+                    for channel in list(user.channels)]
+        return [channel.name for channel in channels if channel is not None]
+
+    def topic(self, channel):
+        channel = self.channels.get(irc_lower(channel))
+        return channel.topic if channel else ''
+
+    def modes(self, channel):
+        """ Returns a copy of channel's modes as a dict of
+            mode : parameter, True or set(parameter).
+        """
+        channel = self.channels.get(irc_lower(channel))
+        if not channel:
+            return {}
+        return dict((mode, set(value) if isinstance(value, set) else value)
+                    for mode, value in channel.modes.items())
+
+    # updates
+
+    def __add_member(self, channel, nick, modes=''):
+        """ Adds nick to channel.
+            For internal use.
+        """
+        lnick = irc_lower(nick)
+        user = self.users.get(lnick)
+        if user is None:
+            user = self.users[lnick] = User(nick)
+        user.channels.add(irc_lower(channel.name))
+        channel.members[lnick] = modes
+
+    def __remove_member(self, lchannel, lnick):
+        """ Removes nick from channel, both given lowercased.
+            For internal use.
+        """
+        channel = self.channels.get(lchannel)
+        if channel:
+            channel.members.pop(lnick, None)
+        user = self.users.get(lnick)
+        if user:
+            user.channels.discard(lchannel)
+            if not user.channels:
+                del self.users[lnick]
+
+    def __remove_channel(self, lchannel):
+        """ Forgets channel and its members.
+            For internal use.
+        """
+        channel = self.channels.pop(lchannel, None)
+        if channel:
+            for lnick in channel.members.keys():
+                user = self.users.get(lnick)
+                if user:
+                    user.channels.discard(lchannel)
+                    if not user.channels:
+                        del self.users[lnick]
+
+    def on_welcome(self, msg):
+        if msg.middle:
+            self.nick = msg.middle[0]
+
+    def on_join(self, msg):
+        nick = msg.source.nick
+        for name in msg.args[0].split(','):
+            lchannel = irc_lower(name)
+            if irc_lower(nick) == irc_lower(self.nick):
+                source = msg.source
+                if source.user and source.host:
+                    self.userhost = '%s@%s' % (source.user, source.host)
+                self.__remove_channel(lchannel)
+                self.channels[lchannel] = Channel(name)
+            channel = self.channels.get(lchannel)
+            if channel:
+                self.__add_member(channel, nick)
+
+    def on_part(self, msg):
+        lnick = irc_lower(msg.source.nick)
+        for name in msg.args[0].split(','):
+            if lnick == irc_lower(self.nick):
+                self.__remove_channel(irc_lower(name))
+            else:
+                self.__remove_member(irc_lower(name), lnick)
+
+    def on_kick(self, msg):
+        args = msg.args
+        if len(args) < 2:
+            return
+        lnick = irc_lower(args[1])
+        if lnick == irc_lower(self.nick):
+            self.__remove_channel(irc_lower(args[0]))
+        else:
+            self.__remove_member(irc_lower(args[0]), lnick)
+
+    def on_quit(self, msg):
+        lnick = irc_lower(msg.source.nick)
+        user = self.users.pop(lnick, None)
+        if user:
+            for lchannel in user.channels:
+                channel = self.channels.get(lchannel)
+                if channel:
+                    channel.members.pop(lnick, None)
+
+    def on_nick(self, msg):
+        old = irc_lower(msg.source.nick)
+        new = msg.args[0] if msg.args else ''
+        if not new:
+            return
+        if old == irc_lower(self.nick):
+            self.nick = new
+        user = self.users.pop(old, None)
+        if user:
+            lnew = irc_lower(new)
+            user.nick = new
+            self.users[lnew] = user
+            for lchannel in user.channels:
+                members = self.channels[lchannel].members
+                members[lnew] = members.pop(old, '')
+
+    def on_mode(self, msg):
+        args = msg.args
+        if len(args) < 2:
+            return
+        self.__apply_modes(args[0], args[1], args[2:])
+
+    def on_channelmodeis(self, msg):
+        args = msg.args
+        if len(args) < 3:
+            return
+        self.__apply_modes(args[1], args[2], args[3:])
+
+    def __apply_modes(self, name, modestring, params):
+        """ Applies a mode change to channel name.
+            For internal use.
+        """
+        channel = self.channels.get(irc_lower(name))
+        if not channel:
+            return
+        params = iter(params)
+        adding = True
+        for mode in modestring:
+            if mode == '+':
+                adding = True
+            elif mode == '-':
+                adding = False
+            elif mode in self.prefix_modes:
+                lnick = irc_lower(next(params, ''))
+                modes = channel.members.get(lnick)
+                if modes is None:
+                    continue
+                if adding:
+                    modes = ''.join(m for m in self.prefix_modes
+                                    if m in modes or m == mode)
+                else:
+                    modes = modes.replace(mode, '')
+                channel.members[lnick] = modes
+            elif mode in self.list_modes:
+                param = next(params, '')
+                masks = channel.modes.setdefault(mode, set())
+                if adding:
+                    masks.add(param)
+                else:
+                    masks.discard(param)
+            elif mode in self.param_modes or (adding and
+                                              mode in self.set_param_modes):
+                param = next(params, '')
+                if adding:
+                    channel.modes[mode] = param
+                else:
+                    channel.modes.pop(mode, None)
+            elif adding:
+                channel.modes[mode] = True
+            else:
+                channel.modes.pop(mode, None)
+
+    def on_topic(self, msg):
+        if not msg.middle:
+            return
+        channel = self.channels.get(irc_lower(msg.middle[0]))
+        if channel:
+            channel.topic = msg.postfix
+
+    def on_topicreply(self, msg):
+        args = msg.args
+        if len(args) < 3:
+            return
+        channel = self.channels.get(irc_lower(args[1]))
+        if channel:
+            channel.topic = args[2]
+
+    def on_namreply(self, msg):
+        args = msg.args
+        if len(args) < 4:
+            return
+        members = self.names.setdefault(irc_lower(args[2]), {})
+        for name in args[3].split():
+            modes = ''
+            while name and name[0] in self.prefix_chars:
+                modes += self.prefix_chars[name[0]]
+                name = name[1:]
+            # names might be in nick!user@host form
+            name = name.split('!', 1)[0]
+            if name:
+                modes = ''.join(m for m in self.prefix_modes if m in modes)
+                members[name] = modes
+
+    def on_endofnames(self, msg):
+        args = msg.args
+        if len(args) < 2:
+            return
+        lchannel = irc_lower(args[1])
+        members = self.names.pop(lchannel, {})
+        channel = self.channels.get(lchannel)
+        if not channel:
+            return
+        for lnick in channel.members.keys():
+            self.__remove_member(lchannel, lnick)
+        for nick, modes in members.iteritems():
+            self.__add_member(channel, nick, modes)
+
+    def on_hosthidden(self, msg):
+        # RPL_HOSTHIDDEN: <nick> <host or user@host> :is now your host
+        if len(msg.middle) < 2:
+            return
+        host = msg.middle[1]
+        if '@' in host:
+            self.userhost = host
+        elif self.userhost:
+            self.userhost = '%s@%s' % (self.userhost.split('@')[0], host)
@@ -0,0 +1,259 @@
+""" Persistent key-value storage for plugins.
+"""
+
+from collections import OrderedDict
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger('mib.storage')
+
+CACHE_LOOKUPS = metrics.counter('mib_storage_cache_total',
+                                'Storage reads by cache result', ('result',))
+WRITES = metrics.counter('mib_storage_writes_total',
+                         'Storage rows written or deleted')
+FLUSH_TIME = metrics.histogram('mib_storage_flush_seconds',
+                               'Time spent writing batches to the database')
+
+# marks a deleted key in the pending writes and a missing key in the cache
+MISSING = object()
+# returned from the cache for keys it doesn't have
+NOT_CACHED = object()
+
+def decode(encoded):
+    """ Decodes a JSON value with the strings as UTF-8 encoded str,
+        like the rest of mib uses them.
+    """
+    return to_str(json.loads(encoded))
+
+def to_str(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [to_str(item) for item in value]
+    if isinstance(value, dict):
+        return dict((to_str(key), to_str(item))
+                    for key, item in value.iteritems())
+    return value
+
+class Storage:
+    """ Key-value store in an SQLite database, shared by the plugins.
+        Keys are strings in namespaces, values anything that can be
+        encoded as JSON. filename must be a file, not ":memory:",
+        because the writer thread has a connection of its own.
+        Reads are served from an LRU cache of at most cache_size keys.
+        Writes go to the cache and to a batch of pending writes which a
+        background thread saves in one transaction every flush_interval
+        seconds, so callers never wait for the disk.
+        The store can be used from several threads.
+    """
+    def __init__(self, filename, cache_size=4096, flush_interval=1.0):
+        self.filename = filename
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.cache = OrderedDict() # (namespace, key) : value or MISSING
+        self.pending = {} # (namespace, key) : encoded value or MISSING
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.flushed = threading.Condition(self.lock)
+        self.flushing = False
+        self.urgent = False # flush() is waiting
+        self.running = True
+        self.db = self.__connect()
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS storage '
+                        '(namespace TEXT, key TEXT, value TEXT, '
+                        'PRIMARY KEY (namespace, key))')
+        self.db.commit()
+        self.writer = threading.Thread(target=self.__write,
+                                       name='storage writer')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def __connect(self):
+        """ Opens a connection to the database.
+            For internal use.
+        """
+        db = sqlite3.connect(self.filename, check_same_thread=False)
+        db.text_factory = str
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def get(self, namespace, key, default=None):
+        """ Returns the value of key in namespace, or default.
+        """
+        item = (namespace, key)
+        with self.lock:
+            value = self.cache.pop(item, NOT_CACHED)
+            if value is not NOT_CACHED:
+                CACHE_LOOKUPS.inc(('hit',))
+                self.cache[item] = value
+                return default if value is MISSING else value
+            encoded = self.pending.get(item)
+            if encoded is None:
+                CACHE_LOOKUPS.inc(('miss',))
+                row = self.db.execute('SELECT value FROM storage '
+                                      'WHERE namespace = ? AND key = ?',
+                                      item).fetchone()
+                encoded = row[0] if row else MISSING
+            value = MISSING if encoded is MISSING else decode(encoded)
+            self.__cache(item, value)
+        return default if value is MISSING else value
+
+    def set(self, namespace, key, value):
+        """ Sets the value of key in namespace.
+            Raises TypeError or ValueError if value can't be encoded.
+        """
+        encoded = json.dumps(value)
+        item = (namespace, key)
+        with self.lock:
+            self.cache.pop(item, None)
+            self.__cache(item, decode(encoded))
+            self.__pend(item, encoded)
+
+    def delete(self, namespace, key):
+        """ Removes key from namespace.
+        """
+        item = (namespace, key)
+        with self.lock:
+            self.cache.pop(item, None)
+            self.__cache(item, MISSING)
+            self.__pend(item, MISSING)
+
+    def keys(self, namespace):
+        """ Returns a list of the keys in namespace.
+        """
+        with self.lock:
+            keys = set(row[0] for row in self.db.execute(
+                'SELECT key FROM storage WHERE namespace = ?', (namespace,)))
+            for (name, key), encoded in self.pending.iteritems():
+                if name != namespace:
+                    continue
+                if encoded is MISSING:
+                    keys.discard(key)
+                else:
+                    keys.add(key)
+        return sorted(keys)
+
+    def __cache(self, item, value):
+        """ Adds item to the cache, forgetting the least recently used
+            item if the cache is full. Must be called with the lock held.
+            For internal use.
+        """
+        if len(self.cache) >= self.cache_size:
+            self.cache.popitem(last=False)
+        self.cache[item] = value
+
+    def __pend(self, item, encoded):
+        """ Adds a write to the next batch. Must be called with the
+            lock held.
+            For internal use.
+        """
+        if not self.pending:
+            self.changed.notify() # starts a new batch
+        self.pending[item] = encoded
+
+    def __write(self):
+        """ Main function of the writer thread.
+            For internal use.
+        """
+        db = self.__connect()
+        while True:
+            with self.lock:
+                while self.running and not self.pending:
+                    self.changed.wait()
+                if self.running and not self.urgent:
+                    # let the batch collect more writes
+                    self.changed.wait(self.flush_interval)
+                self.urgent = False
+                if not self.pending:
+                    if self.running:
+                        continue
+                    break
+                pending = dict(self.pending)
+                self.flushing = True
+            start = time.time()
+            try:
+                self.__save(db, pending)
+            except sqlite3.Error:
+                logger.exception('Unable to save %d keys', len(pending))
+            FLUSH_TIME.observe(time.time() - start)
+            with self.lock:
+                # keep the writes that came in while saving
+                for item, encoded in pending.iteritems():
+                    if self.pending.get(item) is encoded:
+                        del self.pending[item]
+                self.flushing = False
+                self.flushed.notify_all()
+        db.close()
+
+    def __save(self, db, pending):
+        """ Writes pending changes in one transaction.
+            For internal use.
+        """
+        with db:
+            db.executemany('DELETE FROM storage '
+                           'WHERE namespace = ? AND key = ?',
+                           [item for item, encoded in pending.iteritems()
+                            if encoded is MISSING])
+            db.executemany('INSERT OR REPLACE INTO storage VALUES (?, ?, ?)',
+                           [item + (encoded,)
+                            for item, encoded in pending.iteritems()
+                            if encoded is not MISSING])
+        WRITES.inc(amount=len(pending))
+
+    def flush(self):
+        """ Waits until the pending writes have been saved.
+        """
+        with self.lock:
+            self.urgent = True
+            self.changed.notify()
+            while self.pending or self.flushing:
+                self.flushed.wait(self.flush_interval)
+
+    def close(self):
+        """ Saves the pending writes and stops the writer thread.
+        """
+        with self.lock:
+            self.running = False
+            self.changed.notify()
+        self.writer.join()
+        self.db.close()
+
+class PluginStorage:
+    """ The namespace of one plugin in a Storage, used like a dict.
+    """
+    def __init__(self, storage, namespace):
+        self.storage = storage
+        self.namespace = namespace
+
+    def get(self, key, default=None):
+        return self.storage.get(self.namespace, key, default)
+
+    def set(self, key, value):
+        self.storage.set(self.namespace, key, value)
+
+    def delete(self, key):
+        self.storage.delete(self.namespace, key)
+
+    def keys(self):
+        return self.storage.keys(self.namespace)
+
+    def __getitem__(self, key):
+        value = self.get(key, MISSING)
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        self.delete(key)
+
+    def __contains__(self, key):
+        return self.get(key, MISSING) is not MISSING
@@ -0,0 +1,82 @@
+""" Tests of the limit plugin.
+    Run from the top directory of mib:
+        python2 -m unittest tests.test_limit
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'plugins'))
+
+import ircutils
+from masks import PermissionTable
+from parser import parse
+import limit
+
+class FakeExecutor:
+    def configure(self, plugin, **options):
+        pass
+
+class FakeMib:
+    """ The parts of Mib the limit plugin uses.
+    """
+    def __init__(self):
+        self.executor = FakeExecutor()
+        self.command_masks = PermissionTable()
+        self.commands = {}
+
+    def register_privmsg_cmd(self, cmd, function):
+        self.commands[cmd] = function
+
+    def say(self, target, text):
+        pass
+
+    def add_cmd_permission(self, cmd, mask, regexpify=True):
+        if regexpify:
+            mask = ircutils.regexpify(mask)
+        self.command_masks.add(cmd, mask)
+
+    def rm_cmd_permission(self, cmd, mask):
+        self.command_masks.remove(cmd, ircutils.regexpify(mask))
+
+    def command(self, text):
+        msg = parse(':admin!a@example.com PRIVMSG #c :' + text)
+        cmd, _, postfix = text.partition(' ')
+        self.commands[cmd](msg._replace(postfix=postfix))
+
+class ImportTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def start(self):
+        mib = FakeMib()
+        return mib, limit.init(mib)
+
+    def test_deny_removes_imported_permission(self):
+        f = open('limit.cfg', 'w')
+        f.write('topic nick!.*@host.example.com\n')
+        f.close()
+        mib, plugin = self.start()
+        prefix = 'nick!user@host.example.com'
+        other = 'nick!user@hostXexample.com' # . is no longer any character
+        self.assertTrue(mib.command_masks.allowed('topic', prefix))
+        self.assertFalse(mib.command_masks.allowed('topic', other))
+        mib.command('deny nick!*@host.example.com topic')
+        self.assertFalse(mib.command_masks.allowed('topic', prefix))
+        plugin.clean()
+        # and it stays removed after a restart
+        mib, plugin = self.start()
+        self.assertFalse('topic' in mib.command_masks)
+        plugin.clean()
+
+if __name__ == '__main__':
+    unittest.main()
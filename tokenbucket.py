@@ -0,0 +1,45 @@
+""" Token bucket used for pacing and rate limiting.
+"""
+
+import time
+
+class TokenBucket:
+    """ Holds up to burst tokens and refills rate tokens per second.
+    """
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.time()
+
+    def refill(self, now=None):
+        """ Adds the tokens earned since the last refill.
+        """
+        if now is None:
+            now = time.time()
+        if now > self.stamp:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def consume(self, tokens=1, force=False):
+        """ int, (bool) -> bool
+
+            Takes tokens from the bucket if there are enough of them.
+            With force the tokens are always taken, even if the bucket
+            goes below zero.
+            Returns True if the tokens were taken.
+        """
+        self.refill()
+        if self.tokens >= tokens or force:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def delay(self, tokens=1):
+        """ Returns the number of seconds until tokens can be consumed.
+        """
+        self.refill()
+        if self.tokens >= tokens:
+            return 0.0
+        return (tokens - self.tokens) / self.rate
@@ -0,0 +1,583 @@
+""" Running plugins in worker processes.
+    The connection process keeps the IrcSocket, the send queue and the
+    core's state. It sends every line it reads to the worker processes,
+    which load the plugins and handle the lines with a Mib of their own.
+    Lines about a channel go to one worker chosen by the channel, so the
+    messages of a channel are handled in order; lines which aren't about
+    a single channel, such as QUITs and most numerics, go to every worker.
+    Lines the plugins send come back to the connection process's queue.
+
+    The workers are forked by a fork server, a process forked from the
+    connection process before it starts any threads of its own, so they
+    don't inherit its threads, locks or database handles.
+    The connection process writes to the workers without blocking; a
+    worker which falls too far behind is restarted.
+
+    The channel log and the plugin storage are kept by the connection
+    process, and the workers use them through their pipes. Each worker
+    has its own copy of everything else the plugins change: permissions
+    set with the limit plugin, rate limits and metrics only apply in the
+    worker where the change was made, until the workers are restarted.
+"""
+
+from _multiprocessing import Connection
+from collections import deque
+import cPickle
+import errno
+import fcntl
+import logging
+import multiprocessing
+from multiprocessing.reduction import recv_handle, send_handle
+import os
+import signal
+import struct
+import threading
+import time
+
+from eventloop import EventLoop
+from isupport import ISupport
+import log
+import metrics
+from state import irc_lower
+
+logger = logging.getLogger('mib.workers')
+
+RESTARTS = metrics.counter('mib_worker_restarts_total',
+                           'Worker processes started again after a crash')
+
+# seconds to wait before starting a crashed worker again
+RESTART_DELAY = 1.0
+# bytes waiting to be written to a worker before it is restarted
+MAX_BACKLOG = 4 * 1024 * 1024
+# seconds a worker waits for the reply to a request
+REQUEST_TIMEOUT = 30.0
+# methods the workers may call on the connection process's objects
+SERVED = {'storage': ('get', 'set', 'delete', 'keys'),
+          'logstore': ('search', 'seen')}
+
+def shard_key(line, chantypes):
+    """ Returns the channel a line is about, the sender's nick for
+        private messages, or None if the line isn't about a single
+        channel.
+    """
+    if line.startswith('@'):
+        line = line.partition(' ')[2]
+    prefix = ''
+    if line.startswith(':'):
+        prefix, _, line = line.partition(' ')
+    head, _, trailing = line.partition(' :')
+    params = head.split()[1:]
+    if not params and head.upper() == 'JOIN':
+        params = [trailing] # "JOIN :#channel"
+    for param in params:
+        if param[:1] in chantypes:
+            return None if ',' in param else param
+    if params and head[:7].upper() in ('PRIVMSG', 'NOTICE ') and prefix:
+        return prefix[1:].partition('!')[0] # private message
+    return None
+
+class RemoteSocket:
+    """ Stands in for the IrcSocket in a worker process.
+        Lines come from the connection process through reader, and
+        lines sent go back to it through writer.
+    """
+    def __init__(self, reader, writer, nick=''):
+        self.reader = reader
+        self.writer = writer
+        self.nick = nick
+        self.loop = EventLoop()
+        self.isupport = ISupport()
+        self.readline_cbs = set()
+        self.disconnect_cbs = set()
+        self.restore_cbs = set()
+        self.lock = threading.Lock() # plugins send from several threads
+        self.serial = 0
+        self.replies = {} # request id : [Event, succeeded, result]
+        self.deferred = deque() # messages read while waiting for a reply
+
+    def register_readline_cb(self, function):
+        self.readline_cbs.add(function)
+
+    def register_disconnect_cb(self, function):
+        self.disconnect_cbs.add(function)
+
+    def register_restore_cb(self, function):
+        """ Registers a function to be called with the connection
+            process's State when a restarted worker is given it.
+        """
+        self.restore_cbs.add(function)
+
+    def send(self, msg):
+        """ Sends msg to the server through the connection process.
+            Can be called from any thread.
+        """
+        self.__forward(('send', msg))
+
+    def send_lines(self, lines):
+        self.__forward(('send_lines', lines))
+
+    def join(self, channel):
+        self.__forward(('join', channel))
+
+    def quit(self, reason=''):
+        self.__forward(('quit', reason))
+
+    def request(self, name, method, args, kwargs=None):
+        """ Calls method of the object the connection process serves as
+            name with args and kwargs, and returns the result or raises the
+            exception the call raised. Raises IOError if no reply comes.
+            Can be called from any thread.
+        """
+        with self.lock:
+            self.serial += 1
+            ident = self.serial
+            reply = self.replies[ident] = [threading.Event(), False, None]
+            self.writer.send(('request', ident, name, method, args,
+                              kwargs or {}))
+        try:
+            if self.loop.in_loop_thread():
+                self.__wait(reply[0])
+            else:
+                reply[0].wait(REQUEST_TIMEOUT)
+        finally:
+            with self.lock:
+                del self.replies[ident]
+        if not reply[0].is_set():
+            raise IOError('No reply to %s.%s' % (name, method))
+        if not reply[1]:
+            raise reply[2]
+        return reply[2]
+
+    def __wait(self, event):
+        """ Reads messages until event is set by a reply, as the loop
+            can't read them while it is waiting. The other messages are
+            handled after the current callback.
+            For internal use.
+        """
+        deadline = time.time() + REQUEST_TIMEOUT
+        try:
+            while not event.is_set() and \
+                  self.reader.poll(max(deadline - time.time(), 0)):
+                message = self.reader.recv()
+                if message[0] == 'reply':
+                    self.__handle(message)
+                else:
+                    self.deferred.append(message)
+        except EOFError:
+            logger.info('Connection process is gone')
+            self.stop()
+        if self.deferred:
+            self.loop.call_soon(self.__handle_deferred)
+
+    def __forward(self, message):
+        """ For internal use.
+        """
+        with self.lock:
+            self.writer.send(message)
+
+    def __receive(self):
+        """ Handles a message from the connection process.
+            For internal use.
+        """
+        self.__handle_deferred()
+        try:
+            message = self.reader.recv()
+        except EOFError:
+            logger.info('Connection process is gone')
+            self.stop()
+            return
+        self.__handle(message)
+
+    def __handle_deferred(self):
+        """ For internal use.
+        """
+        while self.deferred:
+            self.__handle(self.deferred.popleft())
+
+    def __handle(self, message):
+        """ For internal use.
+        """
+        kind = message[0]
+        if kind == 'lines':
+            for line in message[1]:
+                for function in self.readline_cbs:
+                    function(line)
+        elif kind == 'reply':
+            ident, succeeded, result = message[1:]
+            with self.lock:
+                reply = self.replies.get(ident)
+            if reply is not None:
+                reply[1:] = [succeeded, result]
+                reply[0].set()
+        elif kind == 'disconnect':
+            for function in self.disconnect_cbs:
+                function()
+        elif kind == 'restore':
+            state, tokens = message[1:]
+            self.isupport.tokens.update(tokens)
+            for function in self.restore_cbs:
+                function(state)
+
+    def stop(self):
+        self.loop.remove_reader(self.reader)
+        self.loop.stop()
+
+    def run(self):
+        self.loop.add_reader(self.reader, self.__receive)
+        self.loop.run()
+
+class Remote:
+    """ Stands in for an object the connection process serves as name,
+        such as 'storage'. The methods listed in SERVED are called in
+        the connection process through socket.
+    """
+    def __init__(self, socket, name):
+        self.socket = socket
+        self.name = name
+
+    def __getattr__(self, method):
+        if method not in SERVED[self.name]:
+            raise AttributeError(method)
+        def call(*args, **kwargs):
+            return self.socket.request(self.name, method, args, kwargs)
+        return call
+
+class Worker:
+    """ A worker process and the connection process's ends of its pipes.
+    """
+    def __init__(self, index, pid, reader, writer):
+        self.index = index
+        self.pid = pid
+        self.reader = reader # Connection from the worker
+        self.writer = writer # non-blocking file descriptor to the worker
+        self.alive = True
+        self.lines = [] # lines to send on the next flush
+        self.output = deque() # encoded messages not yet written
+        self.backlog = 0 # bytes in output
+
+class WorkerPool:
+    """ Starts the worker processes and passes lines between them and
+        the IrcSocket of mib. factory is called in each worker process
+        with a RemoteSocket and must return the worker's Mib.
+        The fork server is started right away, so the pool should be
+        created before the connection process starts any threads.
+    """
+    def __init__(self, mib, processes, factory):
+        self.mib = mib
+        self.processes = processes
+        self.factory = factory
+        self.workers = [None] * processes
+        self.services = {} # name : function returning the served object
+        self.flush_scheduled = False
+        self.running = False
+        self.server, server_conn = multiprocessing.Pipe()
+        self.server_process = multiprocessing.Process(
+            target=self.__serve, args=(server_conn,), name='mib fork server')
+        self.server_process.daemon = True
+        self.server_process.start()
+        server_conn.close()
+
+    def serve(self, name, function):
+        """ Lets the workers call the methods listed in SERVED[name] of
+            the object function returns. The calls are run by mib's
+            executor.
+        """
+        self.services[name] = function
+
+    def start(self):
+        """ Starts the workers and begins forwarding lines to them.
+        """
+        self.running = True
+        for index in range(self.processes):
+            self.__start(index)
+        socket = self.mib.socket
+        socket.register_readline_cb(self.forward)
+        socket.register_disconnect_cb(self.__disconnected)
+
+    def __start(self, index):
+        """ Asks the fork server to start worker index.
+            For internal use.
+        """
+        self.server.send(('start', index))
+        reader = Connection(recv_handle(self.server), writable=False)
+        writer = recv_handle(self.server)
+        pid = self.server.recv()
+        flags = fcntl.fcntl(writer, fcntl.F_GETFL)
+        fcntl.fcntl(writer, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        worker = Worker(index, pid, reader, writer)
+        self.workers[index] = worker
+        self.mib.socket.loop.add_reader(reader,
+                                        lambda: self.__receive(worker))
+        logger.info('Started worker %d, pid %d', index, pid)
+        return worker
+
+    def __serve(self, conn):
+        """ Main function of the fork server. Forks a worker for every
+            request from the connection process and sends back the
+            connection process's ends of its pipes and its pid.
+            Stops the workers when conn is closed.
+            For internal use.
+        """
+        log.after_fork()
+        children = {} # pid : worker index
+        while True:
+            try:
+                if not conn.poll(1.0):
+                    self.__reap(children)
+                    continue
+                request = conn.recv()
+            except (EOFError, IOError):
+                break
+            index = request[1]
+            down_reader, down_writer = multiprocessing.Pipe(duplex=False)
+            up_reader, up_writer = multiprocessing.Pipe(duplex=False)
+            pid = os.fork()
+            if pid == 0:
+                conn.close()
+                down_writer.close()
+                up_reader.close()
+                self.__main(down_reader, up_writer)
+            down_reader.close()
+            up_writer.close()
+            children[pid] = index
+            send_handle(conn, up_reader.fileno(), os.getppid())
+            send_handle(conn, down_writer.fileno(), os.getppid())
+            conn.send(pid)
+            up_reader.close()
+            down_writer.close()
+        # the workers stop when their pipes close
+        deadline = time.time() + 5
+        while children and time.time() < deadline:
+            time.sleep(0.1)
+            self.__reap(children)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def __reap(self, children):
+        """ Waits for the workers which have exited.
+            For internal use.
+        """
+        while children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return
+            if not pid:
+                return
+            index = children.pop(pid, None)
+            if os.WIFSIGNALED(status):
+                logger.info('Worker %s was killed by signal %d',
+                            index, os.WTERMSIG(status))
+            elif os.WEXITSTATUS(status):
+                logger.info('Worker %s exited with code %d',
+                            index, os.WEXITSTATUS(status))
+
+    def __main(self, reader, writer):
+        """ Main function of a worker process.
+            For internal use.
+        """
+        code = 0
+        try:
+            log.after_fork()
+            mib = self.factory(RemoteSocket(reader, writer,
+                                            self.mib.socket.nick))
+            mib.load_plugins()
+            try:
+                mib.socket.run()
+            finally:
+                mib.clean()
+                log.shutdown()
+        except BaseException:
+            logger.exception('Worker failed')
+            code = 1
+        finally:
+            os._exit(code)
+
+    def forward(self, line):
+        """ Queues line for the worker of its channel, or every worker.
+            The queued lines are sent once per iteration of the loop.
+        """
+        key = shard_key(line, self.mib.socket.isupport.chantypes())
+        if key is None:
+            for worker in self.workers:
+                worker.lines.append(line)
+        else:
+            index = hash(irc_lower(key)) % self.processes
+            self.workers[index].lines.append(line)
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.mib.socket.loop.call_soon(self.__flush)
+
+    def __flush(self):
+        """ Sends the queued lines to the workers.
+            For internal use.
+        """
+        self.flush_scheduled = False
+        for worker in self.workers:
+            if worker.lines:
+                lines, worker.lines = worker.lines, []
+                self.__send(worker, ('lines', lines))
+
+    def __send(self, worker, message):
+        """ Queues message to be written to worker. Messages to a dead
+            worker are dropped, and a worker with more than MAX_BACKLOG
+            bytes waiting is restarted.
+            For internal use.
+        """
+        if not worker.alive:
+            return
+        data = cPickle.dumps(message, cPickle.HIGHEST_PROTOCOL)
+        # framed like Connection.send, so the worker can recv() it
+        worker.output.append(struct.pack('!I', len(data)) + data)
+        worker.backlog += len(data) + 4
+        if worker.backlog > MAX_BACKLOG:
+            logger.error('Worker %d is %d bytes behind, restarting it',
+                         worker.index, worker.backlog)
+            self.__kill(worker)
+        elif len(worker.output) == 1:
+            self.__write(worker)
+
+    def __write(self, worker):
+        """ Writes as much of worker's output as its pipe takes, and
+            waits for the pipe to become writable if some is left.
+            For internal use.
+        """
+        loop = self.mib.socket.loop
+        while worker.output:
+            try:
+                written = os.write(worker.writer, worker.output[0])
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    break
+                logger.warning('Unable to send to worker %d: %s',
+                               worker.index, e)
+                worker.output.clear()
+                worker.backlog = 0
+                break
+            worker.backlog -= written
+            if written < len(worker.output[0]):
+                worker.output[0] = worker.output[0][written:]
+                break
+            worker.output.popleft()
+        if worker.output:
+            loop.add_writer(worker.writer, lambda: self.__write(worker))
+        else:
+            loop.remove_writer(worker.writer)
+
+    def __kill(self, worker):
+        """ Stops sending to worker and kills it. It is restarted when
+            its pipe closes.
+            For internal use.
+        """
+        self.mib.socket.loop.remove_writer(worker.writer)
+        worker.alive = False
+        worker.output.clear()
+        worker.backlog = 0
+        try:
+            os.kill(worker.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def __disconnected(self):
+        """ Tells the workers that the connection was lost.
+            For internal use.
+        """
+        self.__flush()
+        for worker in self.workers:
+            self.__send(worker, ('disconnect',))
+
+    def __receive(self, worker):
+        """ Handles a message from a worker.
+            For internal use.
+        """
+        try:
+            message = worker.reader.recv()
+        except (EOFError, IOError):
+            self.__crashed(worker)
+            return
+        kind = message[0]
+        socket = self.mib.socket
+        if kind == 'send':
+            socket.send(message[1])
+        elif kind == 'send_lines':
+            socket.send_lines(message[1])
+        elif kind == 'join':
+            socket.join(message[1])
+        elif kind == 'quit':
+            socket.quit(message[1])
+        elif kind == 'request':
+            self.mib.executor.call(__name__, self.__call,
+                                   (worker,) + message[1:])
+
+    def __call(self, worker, ident, name, method, args, kwargs):
+        """ Runs a request of worker and sends the result back.
+            For internal use.
+        """
+        try:
+            if method not in SERVED.get(name, ()) or \
+               name not in self.services:
+                raise AttributeError('%s.%s is not served' % (name, method))
+            result = getattr(self.services[name](), method)(*args, **kwargs)
+            reply = ('reply', ident, True, result)
+        except Exception, e:
+            try:
+                cPickle.dumps(e, cPickle.HIGHEST_PROTOCOL)
+            except Exception:
+                e = RuntimeError('%s: %s' % (e.__class__.__name__, e))
+            reply = ('reply', ident, False, e)
+        self.mib.socket.loop.call_soon_threadsafe(self.__send, worker, reply)
+
+    def __crashed(self, worker):
+        """ Starts a worker again after it has died. The new worker
+            is given the current state, as it missed how it came to be.
+            For internal use.
+        """
+        self.__close(worker)
+        if not self.running:
+            return
+        logger.error('Worker %d died, restarting in %g s',
+                     worker.index, RESTART_DELAY)
+        RESTARTS.inc()
+        self.mib.socket.loop.call_later(RESTART_DELAY, self.__restart,
+                                        worker.index)
+
+    def __close(self, worker):
+        """ Closes the connection process's ends of worker's pipes.
+            For internal use.
+        """
+        loop = self.mib.socket.loop
+        loop.remove_reader(worker.reader)
+        loop.remove_writer(worker.writer)
+        worker.alive = False
+        worker.output.clear()
+        worker.reader.close()
+        os.close(worker.writer)
+
+    def __restart(self, index):
+        """ For internal use.
+        """
+        if not self.running:
+            return
+        try:
+            worker = self.__start(index)
+        except (EOFError, IOError, OSError), e:
+            logger.error('Unable to start worker %d: %s', index, e)
+            return
+        self.__send(worker, ('restore', self.mib.state,
+                             self.mib.socket.isupport.tokens))
+
+    def stop(self):
+        """ Stops the workers and the fork server.
+        """
+        self.running = False
+        for worker in self.workers:
+            if worker is not None and worker.reader is not None:
+                self.__close(worker) # the worker stops when its pipe closes
+                worker.reader = None
+        self.server.close()
+        self.server_process.join(10)
+        if self.server_process.is_alive():
+            self.server_process.terminate()